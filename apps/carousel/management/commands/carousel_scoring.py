@@ -1,12 +1,15 @@
 import html
+import json
+import hashlib
 import datetime
 
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Iterator, List
 from logging import getLogger
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qsl
 
 from django.utils import timezone
-from django.db.models.query_utils import Q
+from django.db.models import Q
 
 from apps.choices import CarouselStatus
 from apps.carousel.models import Carousel, ScoringUrl, ScoringGroup
@@ -14,6 +17,8 @@ from apps.sources.models import TildaLead
 from apps.sources.management.commands._base import BaseCommand
 from apps.utils import detect_channel_by_querystring
 
+from plugins.data import data_reader, data_writer
+
 
 logger = getLogger(__name__)
 
@@ -35,10 +40,84 @@ score_map_channel = {
     "direct": 5,
 }
 
+BAZA_GROUP_NAME = "База оффер"
+
+CHUNK_SIZE = 2000
+
+STATE_FILENAME = "carousel_scoring_state.json"
+
+# Части скоринга, не зависящие от даты
+STATIC_PARTS = ["qa_1", "qa_2", "qa_3", "qa_4", "qa_5", "channel"]
+
+
+@lru_cache(maxsize=100000)
+def parse_roistat_url(value: str) -> Tuple[str, str]:
+    """
+    Адрес страницы без параметров и канал по параметрам roistat_url
+    """
+    parse_url = urlparse(html.unescape(value))
+    channel = detect_channel_by_querystring(dict(parse_qsl(parse_url.query)))
+    return "https://" + parse_url.netloc + parse_url.path, channel
+
+
+class ScoringIndex:
+    """
+    Карты скоринга ScoringGroup и адреса ScoringUrl, загруженные один раз
+    за запуск
+    """
+
+    def __init__(self):
+        self.urls = set(ScoringUrl.objects.values_list("url", flat=True))
+        self.group_maps: Dict[str, dict] = {}
+        for url, scoring_map in (
+            ScoringGroup.objects.filter(urls__isnull=False)
+            .order_by("default")
+            .values_list("urls__url", "scoring_map")
+        ):
+            self.group_maps.setdefault(url, scoring_map)
+        default_group = ScoringGroup.objects.filter(default=True).first()
+        self.default_map = default_group.scoring_map if default_group else {}
+        baza_group = ScoringGroup.objects.filter(name=BAZA_GROUP_NAME).first()
+        self.baza_map = baza_group.scoring_map if baza_group else {}
+
+    def get_map(self, url: str) -> dict:
+        if "baza" in url:
+            return self.baza_map
+        return self.group_maps.get(url, self.default_map) or {}
+
+    def get_channel_score(self, url: str, channel: str) -> int:
+        if url not in self.urls and "baza" in url:
+            return -15
+        return score_map_channel.get(channel, 0)
+
+    def get_hash(self) -> str:
+        return hashlib.md5(
+            json.dumps(
+                [
+                    sorted(self.urls),
+                    self.group_maps,
+                    self.default_map,
+                    self.baza_map,
+                    score_map_channel,
+                ],
+                sort_keys=True,
+                ensure_ascii=False,
+            ).encode()
+        ).hexdigest()
+
 
 class Command(BaseCommand):
     help = "Скоринг лидов"
 
+    index: ScoringIndex
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Пересчет скоринга всех лидов карусели",
+        )
+
     def score_value(self, value: str, score: int) -> Dict[str, Any]:
         return {
             "value": value,
@@ -50,8 +129,10 @@ class Command(BaseCommand):
             str(value), int(score_map_qa.get(num, {}).get(value, 0))
         )
 
-    def score_date(self, value: datetime.datetime) -> int:
-        diff = (timezone.now() - value).days
+    def score_date(
+        self, value: datetime.datetime, now: datetime.datetime = None
+    ) -> int:
+        diff = ((now or timezone.now()) - value).days
         value = -60
         for days, score in score_map_days.items():
             if diff <= days:
@@ -59,71 +140,137 @@ class Command(BaseCommand):
                 break
         return self.score_value(str(diff), int(value))
 
-    def score_channel(self, value: str) -> Dict[str, Any]:
-        parse_url = urlparse(html.unescape(value))
-        params_url = detect_channel_by_querystring(
-            dict(parse_qsl(parse_url.query))
+    def score_lead(
+        self, lead: TildaLead, now: datetime.datetime
+    ) -> Dict[str, Dict[str, Any]]:
+        if all(getattr(lead, f"qa_{i}", "") == "" for i in range(1, 6)):
+            return {"no_answers": self.score_value("", 100)}
+        url, channel = parse_roistat_url(lead.roistat_url)
+        score_map_qa = self.index.get_map(url)
+        return {
+            "qa_1": self.score_qa(score_map_qa, "1", lead.qa_1),
+            "qa_2": self.score_qa(score_map_qa, "2", lead.qa_2),
+            "qa_3": self.score_qa(score_map_qa, "3", lead.qa_3),
+            "qa_4": self.score_qa(score_map_qa, "4", lead.qa_4),
+            "qa_5": self.score_qa(score_map_qa, "5", lead.qa_5),
+            "date": self.score_date(lead.date_created, now),
+            "channel": self.score_value(
+                url, self.index.get_channel_score(url, channel)
+            ),
+        }
+
+    def rescore_date(
+        self, score_info: Dict[str, Dict[str, Any]], lead: TildaLead, now
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Пересчет только даты, остальные части берутся из score_info
+        """
+        if not score_info:
+            return self.score_lead(lead, now)
+        if "no_answers" in score_info:
+            return score_info
+        if not all(part in score_info for part in STATIC_PARTS):
+            return self.score_lead(lead, now)
+        return {**score_info, "date": self.score_date(lead.date_created, now)}
+
+    def get_static(
+        self, score_info: Dict[str, Dict[str, Any]]
+    ) -> Dict[str, Dict[str, Any]]:
+        return dict(
+            (key, value)
+            for key, value in (score_info or {}).items()
+            if key != "date"
         )
-        url = "https://" + parse_url.netloc + parse_url.path
-        detect_group = ScoringUrl.objects.filter(url=url).values()
-        if detect_group:
-            score = score_map_channel.get(params_url, 0)
-        elif "baza" in url:
-            score = -15
-        else:
-            score = score_map_channel.get(params_url, 0)
-        return self.score_value(str(url), int(score))
 
-    def score_map_detect(self, value: str) -> dict:
-        parse_url = urlparse(html.unescape(value))
-        url = "https://" + parse_url.netloc + parse_url.path
-        if "baza" in url:
-            scoring_group = ScoringGroup.objects.filter(
-                name="База оффер"
-            ).first()
-        else:
-            scoring_group = (
-                ScoringGroup.objects.filter(Q(urls__url=url) | Q(default=True))
-                .order_by("default")
-                .first()
+    def get_crossed_filter(
+        self, scored_at: datetime.datetime, now: datetime.datetime
+    ) -> Q:
+        """
+        Лиды, перешедшие порог score_map_days после прошлого запуска
+        """
+        crossed = Q(carousel__score_info__isnull=True)
+        for days in score_map_days.keys():
+            delta = datetime.timedelta(days=days + 1)
+            crossed |= Q(
+                date_created__gt=scored_at - delta,
+                date_created__lte=now - delta,
             )
-        if scoring_group:
-            return scoring_group.scoring_map
-        return {}
+        return crossed
 
-    def handle(self, **kwargs):
-        logger.info("Carousel scoring")
+    def get_state(self) -> Dict[str, Any]:
+        try:
+            return data_reader.dict(STATE_FILENAME)
+        except FileNotFoundError:
+            return {}
 
-        instances = []
+    def get_leads(self, crossed: Q = None) -> Iterator[List[TildaLead]]:
         leads = TildaLead.objects.select_related("carousel").filter(
             carousel__status__in=[
                 CarouselStatus.new.name,
                 CarouselStatus.distributed.name,
             ]
         )
-        for lead in leads:
-            if all(getattr(lead, f"qa_{i}", "") == "" for i in range(1, 6)):
-                score = {"no_answers": self.score_value("", 100)}
-            else:
-                score_map_qa = self.score_map_detect(lead.roistat_url)
-                score = {
-                    "qa_1": self.score_qa(score_map_qa, "1", lead.qa_1),
-                    "qa_2": self.score_qa(score_map_qa, "2", lead.qa_2),
-                    "qa_3": self.score_qa(score_map_qa, "3", lead.qa_3),
-                    "qa_4": self.score_qa(score_map_qa, "4", lead.qa_4),
-                    "qa_5": self.score_qa(score_map_qa, "5", lead.qa_5),
-                    "date": self.score_date(lead.date_created),
-                    "channel": self.score_channel(lead.roistat_url),
-                }
-            instance = lead.carousel
-            instance.status = CarouselStatus.distributed.name
-            instance.score = sum(value.get("score") for value in score.values())
-            instance.score_info = score
-            instance.updated = timezone.now()
-            instances.append(instance)
-
-        Carousel.objects.bulk_update(
-            instances,
-            ["status", "score", "score_info", "updated"],
-            batch_size=1000,
+        if crossed is not None:
+            leads = leads.filter(
+                Q(carousel__status=CarouselStatus.new.name) | crossed
+            )
+        leads = leads.order_by("pk")
+        chunk = []
+        for lead in leads.iterator(chunk_size=CHUNK_SIZE):
+            chunk.append(lead)
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def handle(self, full: bool = False, **kwargs):
+        logger.info("Carousel scoring")
+
+        self.index = ScoringIndex()
+        now = timezone.now()
+        maps = self.index.get_hash()
+        state = self.get_state()
+        full = full or state.get("maps") != maps or not state.get("scored_at")
+        crossed = None
+        if full:
+            logger.info("  ↳ Full rescoring")
+        else:
+            crossed = self.get_crossed_filter(
+                datetime.datetime.fromisoformat(state.get("scored_at")), now
+            )
+
+        quantity = 0
+        for leads in self.get_leads(crossed):
+            instances = []
+            for lead in leads:
+                instance = lead.carousel
+                if full or instance.status == CarouselStatus.new.name:
+                    score = self.score_lead(lead, now)
+                else:
+                    score = self.rescore_date(instance.score_info, lead, now)
+                total = sum(value.get("score") for value in score.values())
+                if (
+                    instance.status == CarouselStatus.distributed.name
+                    and instance.score == total
+                    and self.get_static(instance.score_info)
+                    == self.get_static(score)
+                ):
+                    continue
+                instance.status = CarouselStatus.distributed.name
+                instance.score = total
+                instance.score_info = score
+                instance.updated = now
+                instances.append(instance)
+
+            Carousel.objects.bulk_update(
+                instances,
+                ["status", "score", "score_info", "updated"],
+                batch_size=1000,
+            )
+            quantity += len(instances)
+
+        data_writer.dict(
+            {"maps": maps, "scored_at": now.isoformat()}, STATE_FILENAME
         )
+        logger.info("  ↳ Updated: %(quantity)d" % {"quantity": quantity})
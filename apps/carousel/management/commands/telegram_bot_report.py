@@ -4,16 +4,15 @@ import time
 import pandas
 import requests
 
-from collections import Counter
 from logging import getLogger
 from urllib.parse import urlparse
 
-from django.db.models import Avg
+from django.db.models import Avg, Count, Q, Exists, OuterRef, Subquery
 
 from apps.carousel.models import Carousel
 from apps.choices import CarouselStatus
-from apps.utils import queryset_as_dataframe
-from apps.sources.models import TildaLead, Lead
+from apps.sources.models import TildaLead
+from apps.traffic.models import LeadEmail, LeadEmailCount
 from config import settings
 
 from apps.sources.management.commands._base import BaseCommand
@@ -45,27 +44,31 @@ class Command(BaseCommand):
 
     def first_report(self, df: datetime.datetime, dt: datetime.datetime) -> str:
         logger.info("  ↳Create first report")
-        leads = queryset_as_dataframe(TildaLead.objects.filter(date_created__range=(df, dt)))
-        leads['category'] = leads['roistat_url'].apply(self.parse_url)
-        distribution = list(Carousel.objects.filter(created__range=(df, dt), distribution__range=(df, dt),
-                                                    status__in=[CarouselStatus.complete.name,
-                                                                CarouselStatus.qualified.name,
-                                                                CarouselStatus.unqualified.name]).values_list(
-            'owner__email', flat=True))
-        qualified_count = Carousel.objects.filter(created__range=(df, dt), distribution__range=(df, dt),
-                                                  status=CarouselStatus.qualified.name).count()
-        unqualified_count = Carousel.objects.filter(created__range=(df, dt), distribution__range=(df, dt),
-                                                    status=CarouselStatus.unqualified.name).count()
-        avg_score_count = round(
-            Carousel.objects.filter(created__range=(df, dt), distribution__range=(df, dt)).aggregate(Avg('score'))[
-                'score__avg'])
-
-        full_count = len(leads)
-        baza_count = leads['category'].sum()
+        urls = TildaLead.objects.filter(date_created__range=(df, dt)).values_list('roistat_url', flat=True)
+        full_count = 0
+        baza_count = 0
+        for url in urls:
+            full_count += 1
+            baza_count += self.parse_url(url)
+
+        distributed = Q(status__in=[CarouselStatus.complete.name,
+                                    CarouselStatus.qualified.name,
+                                    CarouselStatus.unqualified.name])
+        stats = Carousel.objects.filter(created__range=(df, dt), distribution__range=(df, dt)).aggregate(
+            distribution_count=Count('pk', filter=distributed),
+            openers_count=Count('owner__email', filter=distributed, distinct=True),
+            qualified_count=Count('pk', filter=Q(status=CarouselStatus.qualified.name)),
+            unqualified_count=Count('pk', filter=Q(status=CarouselStatus.unqualified.name)),
+            avg_score=Avg('score'),
+        )
+
         paid_count = full_count - baza_count
-        distribution_count = len(distribution)
-        openers_count = (len(set(distribution)))
-        lead_per_opener_count = round(distribution_count / openers_count)
+        distribution_count = stats['distribution_count']
+        openers_count = stats['openers_count']
+        qualified_count = stats['qualified_count']
+        unqualified_count = stats['unqualified_count']
+        avg_score_count = round(stats['avg_score'] or 0)
+        lead_per_opener_count = round(distribution_count / openers_count) if openers_count else 0
         report_row = f'Отчет №1. Количество распределенных за вчера.\n\nКоличество пришедших лидов общее: {full_count}\nКоличество пришедших лидов база: {baza_count}\nКоличество пришедших лидов платный трафик: {paid_count}\nКоличество опенеров на смене: {openers_count}\nКоличество распределенных лидов: {distribution_count}\nКоличество распределенных на 1 опенера: {lead_per_opener_count}\nКоличество квал.лидов: {qualified_count}\nКоличество неквал.лидов: {unqualified_count}\nСредний балл распределенных лидов: {avg_score_count}\n'
         return report_row
 
@@ -97,40 +100,36 @@ class Command(BaseCommand):
 
     def third_report(self, df: datetime.datetime, dt: datetime.datetime) -> str:
         logger.info("  ↳Create third report")
-        score_gte30_yesterday = Carousel.objects.filter(
-            created__range=(df, dt), score__gte=30,
-            status__in=[CarouselStatus.new.name, CarouselStatus.distributed.name]
-        ).values_list('lead__email', flat=True)
-
-        score_lte29_yesterday = Carousel.objects.filter(
-            created__range=(df, dt), score__lte=29,
-            status__in=[CarouselStatus.new.name, CarouselStatus.distributed.name]
-        ).values_list('lead__email', flat=True)
-
         current_date = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
         thursday = self.get_thursday(current_date)
         wednesday = self.get_wednesday(current_date)
 
-        score_gte30_segment = Carousel.objects.filter(
-            created__range=(thursday, wednesday), score__gte=30,
+        yesterday = Q(created__range=(df, dt))
+        segment = Q(created__range=(thursday, wednesday))
+        carousel = Carousel.objects.filter(
+            yesterday | segment,
             status__in=[CarouselStatus.new.name, CarouselStatus.distributed.name]
-        ).values_list('lead__email', flat=True)
-
-        score_lte29_segment = Carousel.objects.filter(
-            created__range=(thursday, wednesday), score__lte=29,
-            status__in=[CarouselStatus.new.name, CarouselStatus.distributed.name]
-        ).values_list('lead__email', flat=True)
-
-        db_email_list = list(Lead.objects.values_list("email", flat=True))
-        email_counter = Counter(db_email_list)
-
-        double_gte30_yesterday = sum(email_counter[email] > 1 for email in score_gte30_yesterday)
-        double_lte29_yesterday = sum(email_counter[email] > 1 for email in score_lte29_yesterday)
-
-        double_gte30_segment = sum(email_counter[email] > 1 for email in score_gte30_segment)
-        double_lte29_segment = sum(email_counter[email] > 1 for email in score_lte29_segment)
-
-        result_row = f'Отчет №3. Состав хвоста.\n\nВчерашний день:\nКоличество лидов с суммой баллов до 29: {score_lte29_yesterday.count()}\nИз них количество дублей: {double_lte29_yesterday}\nКоличество лидов с суммой баллов от 30: {score_gte30_yesterday.count()}\nИз них количество дублей: {double_gte30_yesterday}\n\nПериод с {thursday.date()} по {wednesday.date()}:\nКоличество лидов с суммой баллов до 29: {score_lte29_segment.count()}\nИз них количество дублей: {double_lte29_segment}\nКоличество лидов с суммой баллов от 30: {score_gte30_segment.count()}\nИз них количество дублей: {double_gte30_segment}'
+        ).annotate(
+            lead_email=Subquery(LeadEmail.objects.filter(lead_id=OuterRef('lead_id')).values('email')[:1])
+        ).annotate(
+            is_double=Exists(LeadEmailCount.objects.filter(email=OuterRef('lead_email'), quantity__gt=1))
+        )
+        double = Q(is_double=True)
+        gte30 = Q(score__gte=30)
+        lte29 = Q(score__lte=29)
+
+        stats = carousel.aggregate(
+            gte30_yesterday=Count('pk', filter=yesterday & gte30),
+            lte29_yesterday=Count('pk', filter=yesterday & lte29),
+            gte30_segment=Count('pk', filter=segment & gte30),
+            lte29_segment=Count('pk', filter=segment & lte29),
+            double_gte30_yesterday=Count('pk', filter=yesterday & gte30 & double),
+            double_lte29_yesterday=Count('pk', filter=yesterday & lte29 & double),
+            double_gte30_segment=Count('pk', filter=segment & gte30 & double),
+            double_lte29_segment=Count('pk', filter=segment & lte29 & double),
+        )
+
+        result_row = f'Отчет №3. Состав хвоста.\n\nВчерашний день:\nКоличество лидов с суммой баллов до 29: {stats["lte29_yesterday"]}\nИз них количество дублей: {stats["double_lte29_yesterday"]}\nКоличество лидов с суммой баллов от 30: {stats["gte30_yesterday"]}\nИз них количество дублей: {stats["double_gte30_yesterday"]}\n\nПериод с {thursday.date()} по {wednesday.date()}:\nКоличество лидов с суммой баллов до 29: {stats["lte29_segment"]}\nИз них количество дублей: {stats["double_lte29_segment"]}\nКоличество лидов с суммой баллов от 30: {stats["gte30_segment"]}\nИз них количество дублей: {stats["double_gte30_segment"]}'
         return result_row
 
     def send_telegram_message(self, text: str):
@@ -33,11 +33,10 @@ from apps.choices import RoistatDimensionType, UserGroup
 from apps.datatable.base import DatatableDataframeView
 from apps.sources.models import (
     Lead,
-    RoistatAnalytic,
     PaymentAnalytic,
     RoistatDimension,
 )
-from apps.traffic.models import FunnelChannelUrl, Channel
+from apps.traffic.models import FunnelChannelUrl, Channel, ExpensesDaily
 from apps.views.mixins import LPRequiredMixin
 from plugins.data import data_reader
 
@@ -602,30 +601,26 @@ class TraficOffersView(LPRequiredMixin, DatatableDataframeView):
 
                 expenses: pandas.DataFrame = pandas.DataFrame(
                     list(
-                        RoistatAnalytic.objects.filter(
+                        ExpensesDaily.objects.filter(
                             date__gte=lead_df, date__lte=lead_dt
                         ).values(
                             "date",
                             "expenses",
-                            "dimension_landing_page__name",
-                            "dimension_marker_level_1__name",
+                            "landing_name",
+                            "channel_name",
                         )
                     )
                 )
                 if not expenses.empty:
-                    expenses["category"] = expenses[
-                        "dimension_landing_page__name"
-                    ].apply(detect_category_url, args=(category,))
-                    expenses["channel"] = expenses[
-                        "dimension_marker_level_1__name"
-                    ].apply(detect_expenses_channel, args=(channel,))
+                    expenses["category"] = expenses["landing_name"].apply(
+                        detect_category_url, args=(category,)
+                    )
+                    expenses["channel"] = expenses["channel_name"].apply(
+                        detect_expenses_channel, args=(channel,)
+                    )
                     expenses.dropna(inplace=True)
                     expenses.drop(
-                        columns=[
-                            "dimension_marker_level_1__name",
-                            "dimension_landing_page__name",
-                            "date",
-                        ],
+                        columns=["channel_name", "landing_name", "date"],
                         inplace=True,
                     )
                     expenses = (
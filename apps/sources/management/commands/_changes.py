@@ -0,0 +1,54 @@
+import datetime
+
+from typing import Dict, Iterable, Set
+
+from plugins.data import data_reader, data_writer
+
+
+def get_changes(name: str) -> Dict[str, float]:
+    try:
+        return data_reader.dict(f"{name}_changes.json")
+    except FileNotFoundError:
+        return {}
+
+
+def mark_changed(name: str, dates: Iterable[datetime.date]):
+    """
+    Отметка дат, данные за которые изменились, с временем изменения
+    """
+    dates = list(dates)
+    if not dates:
+        return
+    changes = get_changes(name)
+    timestamp = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    changes.update(dict((date.isoformat(), timestamp) for date in dates))
+    data_writer.dict(changes, f"{name}_changes.json")
+
+
+def get_changed(name: str, since: float = 0) -> Set[datetime.date]:
+    """
+    Даты, изменившиеся после момента since (timestamp)
+    """
+    return set(
+        datetime.date.fromisoformat(date)
+        for date, timestamp in get_changes(name).items()
+        if timestamp > since
+    )
+
+
+def get_cursor(name: str, consumer: str) -> float:
+    """
+    Момент (timestamp), до которого consumer обработал ленту name. Лента
+    общая для нескольких потребителей и не очищается, у каждого свой
+    курсор
+    """
+    try:
+        return data_reader.dict(f"{name}_cursor_{consumer}.json").get(
+            "timestamp", 0
+        )
+    except FileNotFoundError:
+        return 0
+
+
+def set_cursor(name: str, consumer: str, timestamp: float):
+    data_writer.dict({"timestamp": timestamp}, f"{name}_cursor_{consumer}.json")
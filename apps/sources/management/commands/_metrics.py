@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import cProfile
+import resource
+import datetime
+import threading
+
+from typing import Dict, Any, List, Optional
+from logging import getLogger
+from contextlib import contextmanager
+
+import requests
+
+from django.conf import settings
+from django.db import connection
+
+from plugins.amocrm.transport import transport
+
+
+logger = getLogger(__name__)
+
+METRICS_DIR = getattr(settings, "COMMAND_METRICS_DIR", "/tmp/command_metrics")
+
+# Этапы короче этого времени не сохраняются в --profile
+PROFILE_MIN_SECONDS = 1
+
+# Значения этапа, которые суммируются для .prom
+STAGE_KEYS = ["seconds", "rows_in", "rows_out", "db_queries", "api_calls"]
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.calls += 1
+            self.seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            return {"calls": self.calls, "seconds": self.seconds}
+
+    def merge(self, delta: Dict[str, float]):
+        with self.lock:
+            self.calls += delta["calls"]
+            self.seconds += delta["seconds"]
+
+
+class Metrics:
+    """
+    Метрики выполнения команды по этапам: время, строки на входе и выходе,
+    пиковая память, количество и время запросов к БД и внешним API.
+
+    Результат пишется в METRICS_DIR: <command>.jsonl (строка на этап и
+    итоговая строка запуска) и <command>.prom для node_exporter textfile,
+    в .prom повторяющиеся этапы суммируются по имени. При profile этапы
+    дольше PROFILE_MIN_SECONDS сохраняются в .prof (pstats, открывается
+    snakeviz/pyprof2calltree).
+
+    Запросы к БД считаются для соединения потока, запустившего команду.
+    Запросы к API считаются для общей сессии amoCRM, другие сессии команда
+    добавляет через track.
+    Дочерние процессы возвращают свои счетчики через get_delta, родитель
+    добавляет их через merge.
+    """
+
+    def __init__(self, command: str, profile: bool = False):
+        self.command = command
+        self.profile = profile
+        self.stages: List[Dict[str, Any]] = []
+        self.db = Counter()
+        self.api = Counter()
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db.add(time.monotonic() - started)
+
+    def count_api(self, response, *args, **kwargs):
+        self.api.add(response.elapsed.total_seconds())
+
+    @contextmanager
+    def track(self, *sessions: requests.Session):
+        """
+        Подсчет запросов сессий через hook ответа, без подмены
+        requests.Session
+        """
+        for session in sessions:
+            session.hooks["response"].append(self.count_api)
+        try:
+            yield
+        finally:
+            for session in sessions:
+                session.hooks["response"].remove(self.count_api)
+
+    def get_delta(
+        self, before: Dict[str, Dict[str, float]]
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        Прирост счетчиков с момента snapshot before
+        """
+        after = self.snapshot()
+        return dict(
+            (
+                name,
+                {
+                    "calls": after[name]["calls"] - before[name]["calls"],
+                    "seconds": after[name]["seconds"] - before[name]["seconds"],
+                },
+            )
+            for name in ["db", "api"]
+        )
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {"db": self.db.snapshot(), "api": self.api.snapshot()}
+
+    def merge(self, delta: Dict[str, Dict[str, float]]):
+        self.db.merge(delta["db"])
+        self.api.merge(delta["api"])
+
+    def get_peak_rss(self) -> int:
+        # ru_maxrss в килобайтах в Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None):
+        """
+        Этап команды, количество строк на выходе задается через
+        stage["rows_out"] внутри блока
+        """
+        stage = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        db, api = self.db.snapshot(), self.api.snapshot()
+        profiler = cProfile.Profile() if self.profile else None
+        started = time.monotonic()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            stage["seconds"] = time.monotonic() - started
+            db_after, api_after = self.db.snapshot(), self.api.snapshot()
+            stage.update(
+                {
+                    "db_queries": db_after["calls"] - db["calls"],
+                    "db_seconds": db_after["seconds"] - db["seconds"],
+                    "api_calls": api_after["calls"] - api["calls"],
+                    "api_seconds": api_after["seconds"] - api["seconds"],
+                    "peak_rss": self.get_peak_rss(),
+                }
+            )
+            if profiler is not None and stage["seconds"] >= PROFILE_MIN_SECONDS:
+                stage["profile"] = self.get_path(
+                    f"{self.command}_{name}_{self.started:%Y%m%dT%H%M%S}"
+                    f"_{len(self.stages)}.prof"
+                )
+                profiler.dump_stats(stage["profile"])
+            self.stages.append(stage)
+            logger.info(
+                "  ↳ Stage %(stage)s: %(seconds).2fs, db: %(db_queries)d, api: %(api_calls)d"
+                % stage
+            )
+
+    @contextmanager
+    def run(self):
+        started = time.monotonic()
+        success = False
+        with connection.execute_wrapper(self.query_wrapper), self.track(
+            transport.session
+        ):
+            try:
+                yield self
+                success = True
+            finally:
+                self.write(time.monotonic() - started, success)
+
+    def get_path(self, filename: str) -> str:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        return os.path.join(METRICS_DIR, filename)
+
+    def get_summary(self, seconds: float, success: bool) -> Dict[str, Any]:
+        db, api = self.db.snapshot(), self.api.snapshot()
+        return {
+            "stage": None,
+            "seconds": seconds,
+            "success": success,
+            "db_queries": db["calls"],
+            "db_seconds": db["seconds"],
+            "api_calls": api["calls"],
+            "api_seconds": api["seconds"],
+            "peak_rss": self.get_peak_rss(),
+        }
+
+    def get_stages(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Этапы, суммированные по имени (этап может повторяться в цикле)
+        """
+        stages = {}
+        for stage in self.stages:
+            total = stages.setdefault(stage["stage"], {"runs": 0})
+            total["runs"] += 1
+            for key in STAGE_KEYS:
+                if stage.get(key) is not None:
+                    total[key] = total.get(key, 0) + stage[key]
+        return stages
+
+    def get_prometheus(self, summary: Dict[str, Any]) -> str:
+        labels = f'command="{self.command}"'
+        metrics = [
+            (f"command_{key}", [(labels, summary[key])])
+            for key in ["db_queries", "db_seconds", "api_calls", "api_seconds"]
+        ]
+        metrics += [
+            ("command_duration_seconds", [(labels, summary["seconds"])]),
+            ("command_peak_rss_bytes", [(labels, summary["peak_rss"])]),
+            ("command_success", [(labels, int(summary["success"]))]),
+            ("command_last_run_timestamp", [(labels, self.started.timestamp())]),
+        ]
+        stages = self.get_stages()
+        for key in ["runs"] + STAGE_KEYS:
+            samples = [
+                (f'{labels},stage="{name}"', stage[key])
+                for name, stage in stages.items()
+                if key in stage
+            ]
+            if samples:
+                metrics.append((f"command_stage_{key}", samples))
+
+        # Все значения одного метрического имени идут подряд после # TYPE
+        lines = []
+        for name, samples in metrics:
+            lines.append(f"# TYPE {name} gauge")
+            lines += [
+                f"{name}{{{sample_labels}}} {value}"
+                for sample_labels, value in samples
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, seconds: float, success: bool):
+        summary = self.get_summary(seconds, success)
+        try:
+            with open(self.get_path(f"{self.command}.jsonl"), "a") as file:
+                for item in self.stages + [summary]:
+                    file.write(
+                        json.dumps(
+                            {
+                                "command": self.command,
+                                "started": self.started.isoformat(),
+                                **item,
+                            }
+                        )
+                        + "\n"
+                    )
+            # Атомарная замена, чтобы node_exporter не прочитал файл частично
+            path = self.get_path(f"{self.command}.prom")
+            with open(f"{path}.tmp", "w") as file:
+                file.write(self.get_prometheus(summary))
+            os.replace(f"{path}.tmp", path)
+        except OSError as error:
+            logger.warning("Metrics not written: %(error)s" % {"error": error})
+
+
+class MetricsMixin:
+    """
+    Метрики для команды: self.metrics доступен в handle, флаг --profile
+    включает cProfile для этапов
+    """
+
+    metrics: Metrics
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Сохранение cProfile медленных этапов",
+        )
+        return parser
+
+    def execute(self, *args, **options):
+        self.metrics = Metrics(
+            self.__module__.rsplit(".", 1)[-1], options.pop("profile", False)
+        )
+        with self.metrics.run():
+            return super().execute(*args, **options)
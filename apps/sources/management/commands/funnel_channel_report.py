@@ -11,6 +11,7 @@ from apps.traffic.models import FunnelChannelUrl
 from plugins.data import data_writer, data_reader
 
 from ._base import BaseCommand
+from ._metrics import MetricsMixin
 
 
 logger = getLogger(__name__)
@@ -19,7 +20,7 @@ FILENAME_PROFIT = "funnel_channel_profit.pkl"
 FILENAME_EXPENSES = "funnel_channel_expenses.pkl"
 
 
-class Command(BaseCommand):
+class Command(MetricsMixin, BaseCommand):
     help = "Формирование файлов оборота и расхода для отчета funnel_channel"
 
     def get_rels(self) -> dict:
@@ -127,13 +128,18 @@ class Command(BaseCommand):
         RELS = self.get_rels()
         GROUP_CHOICES = dict(FunnelChannelUrlType.choices())
 
-        profit = self.create_profit_part(RELS, GROUP_CHOICES)
+        with self.metrics.stage("profit") as stage:
+            profit = self.create_profit_part(RELS, GROUP_CHOICES)
+            stage["rows_out"] = len(profit) if profit is not None else 0
         if profit is None:
             return
 
-        expenses = self.create_expenses_part(RELS, GROUP_CHOICES)
+        with self.metrics.stage("expenses") as stage:
+            expenses = self.create_expenses_part(RELS, GROUP_CHOICES)
+            stage["rows_out"] = len(expenses) if expenses is not None else 0
         if expenses is None:
             return
 
-        data_writer.dataframe(profit, FILENAME_PROFIT)
-        data_writer.dataframe(expenses, FILENAME_EXPENSES)
+        with self.metrics.stage("save", rows_in=len(profit) + len(expenses)):
+            data_writer.dataframe(profit, FILENAME_PROFIT)
+            data_writer.dataframe(expenses, FILENAME_EXPENSES)
@@ -1,12 +1,15 @@
+import math
 import pytz
 import pandas
 import datetime
+import multiprocessing
 
-from time import sleep
-from typing import Dict
+from typing import Dict, List, Set, Tuple
 from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor
 
 from django.conf import settings
+from django.db import connections
 from django.core.management.base import BaseCommand
 
 from apps.utils import (
@@ -19,17 +22,34 @@ from apps.sources.models import RoistatAnalytic, RoistatDimension
 
 from plugins.data import data_reader, data_writer
 
+from ._changes import get_changed, get_cursor, set_cursor
+from ._metrics import MetricsMixin
+
 
 logger = getLogger(__name__)
 
 FILENAME = "ipl_report.pkl"
+# Посчитанные дни отчета, в том числе без строк RoistatAnalytic
+STATE_FILENAME = "ipl_report_state.json"
 ANALYTIC_TZ = pytz.timezone(settings.ANALYTIC_TIME_ZONE)
 IPL_REPORT_COLUMNS = ["date", "expenses", "landing"] + [
     item.name for item in LeadLevel
 ]
 
+# Команда, выполняющая дни в дочерних процессах (наследуется при fork)
+worker_command = None
+
+
+def create_day_report(
+    date: datetime.date,
+) -> Tuple[pandas.DataFrame, Dict[str, Dict[str, float]]]:
+    # Счетчики дочернего процесса возвращаются родителю вместе с отчетом
+    before = worker_command.metrics.snapshot()
+    report = worker_command.create_day_report(date)
+    return report, worker_command.metrics.get_delta(before)
+
 
-class Command(BaseCommand):
+class Command(MetricsMixin, BaseCommand):
     help = 'Расходы для отчета "IPL по каналам"'
 
     dimensions_level_1: Dict[int, RoistatDimension]
@@ -58,6 +78,19 @@ class Command(BaseCommand):
         parser.add_argument(
             "-dt", "--date-to", required=False, type=self.parse_date
         )
+        parser.add_argument(
+            "--workers",
+            required=False,
+            type=int,
+            default=1,
+            help="Количество процессов, между которыми делятся дни",
+        )
+        parser.add_argument(
+            "--changed",
+            action="store_true",
+            help="Только дни, измененные в RoistatAnalytic, и еще не "
+            "посчитанные",
+        )
 
     def date_range(
         self,
@@ -120,6 +153,37 @@ class Command(BaseCommand):
         )
         return roistat
 
+    def create_day_report(self, date: datetime.date) -> pandas.DataFrame:
+        logger.info("  ↳ Update report: %(date)s" % {"date": date})
+        return self.create_report(self.get_roistat_analytic(date))
+
+    def create_reports(
+        self, dates: List[datetime.date], workers: int
+    ) -> List[pandas.DataFrame]:
+        """
+        Отчеты по дням в пуле процессов, каждому процессу достается
+        непрерывный отрезок дат
+        """
+        global worker_command
+
+        if not dates:
+            return []
+        worker_command = self
+        # Дочерние процессы открывают собственные соединения с БД
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            reports = []
+            for report, delta in executor.map(
+                create_day_report,
+                dates,
+                chunksize=max(1, math.ceil(len(dates) / max(workers, 1))),
+            ):
+                self.metrics.merge(delta)
+                reports.append(report)
+            return reports
+
     def save_levels(self, dataframe: pandas.DataFrame):
         for level in ["account", "campaign", "group", "ad", "landing"]:
             items = dataframe[level].unique().tolist()
@@ -136,9 +200,49 @@ class Command(BaseCommand):
                 f"ipl_report_level_{level}.json",
             )
 
+    def get_computed(self, dataframe: pandas.DataFrame) -> Set[datetime.date]:
+        """
+        Посчитанные дни, без файла состояния - дни со строками в отчете
+        """
+        try:
+            dates = data_reader.dict(STATE_FILENAME).get("dates", [])
+        except FileNotFoundError:
+            return set(dataframe["date"])
+        return set(map(datetime.date.fromisoformat, dates))
+
+    def get_dates(
+        self,
+        date_from: datetime.date,
+        date_to: datetime.date,
+        computed: Set[datetime.date],
+        changed: bool,
+    ) -> List[datetime.date]:
+        """
+        Дни отчета для пересчета, при changed - только измененные в
+        RoistatAnalytic после прошлого запуска и еще не посчитанные
+        """
+        dates = [
+            date_from + datetime.timedelta(days=days)
+            for days in range((date_to - date_from).days + 1)
+        ]
+        if not changed:
+            return dates
+        changed_dates = get_changed(
+            "roistat_analytic", get_cursor("roistat_analytic", "ipl_report")
+        )
+        return [
+            date for date in dates if date in changed_dates or date not in computed
+        ]
+
     def handle(
-        self, date_from: datetime.date, date_to: datetime.date = None, **kwargs
+        self,
+        date_from: datetime.date,
+        date_to: datetime.date = None,
+        workers: int = 1,
+        changed: bool = False,
+        **kwargs
     ):
+        started = datetime.datetime.now(datetime.timezone.utc).timestamp()
         if date_to is None:
             date_to = datetime.datetime.now().astimezone(ANALYTIC_TZ).date()
 
@@ -154,26 +258,52 @@ class Command(BaseCommand):
 
         try:
             dataframe = data_reader.dataframe(FILENAME)
+            computed = self.get_computed(dataframe)
         except FileNotFoundError:
             dataframe = pandas.DataFrame(columns=IPL_REPORT_COLUMNS)
+            computed = set()
+
+        dates = self.get_dates(date_from, date_to, computed, changed)
+        computed.update(dates)
+        logger.info("  ↳ Days to update: %(quantity)d" % {"quantity": len(dates)})
 
-        while date_from <= date_to:
-            logger.info("  ↳ Update report: %(date)s" % {"date": date_from})
+        if workers > 1 and dates:
+            with self.metrics.stage("report") as stage:
+                reports = self.create_reports(dates, workers)
+                stage["rows_out"] = sum(map(len, reports))
+            dataframe = pandas.concat(
+                [dataframe[~dataframe["date"].isin(dates)]] + reports,
+                ignore_index=True,
+            ).sort_values(by="date", ignore_index=True)
+            dates = []
+
+        for date in dates:
+            logger.info("  ↳ Update report: %(date)s" % {"date": date})
 
-            roistat_analytic = self.get_roistat_analytic(date_from)
-            dataframe_period = self.create_report(roistat_analytic)
+            with self.metrics.stage("load") as stage:
+                roistat_analytic = self.get_roistat_analytic(date)
+                stage["rows_out"] = len(roistat_analytic)
+            with self.metrics.stage(
+                "report", rows_in=len(roistat_analytic)
+            ) as stage:
+                dataframe_period = self.create_report(roistat_analytic)
+                stage["rows_out"] = len(dataframe_period)
 
-            dataframe = dataframe[dataframe["date"] != date_from]
+            dataframe = dataframe[dataframe["date"] != date]
             dataframe = pandas.concat(
                 [dataframe, dataframe_period], ignore_index=True
             ).sort_values(by="date", ignore_index=True)
 
-            sleep(1)
-            date_from += datetime.timedelta(days=1)
-
         rel_columns = ["landing"] + [item.name for item in LeadLevel]
         dataframe[rel_columns] = dataframe[rel_columns].fillna(0).astype(int)
 
-        self.save_levels(dataframe)
+        with self.metrics.stage("save", rows_in=len(dataframe)):
+            self.save_levels(dataframe)
+            data_writer.dataframe(dataframe, FILENAME)
+            data_writer.dict(
+                {"dates": sorted(date.isoformat() for date in computed)},
+                STATE_FILENAME,
+            )
 
-        data_writer.dataframe(dataframe, FILENAME)
+        # Изменения до начала запуска учтены в отчете
+        set_cursor("roistat_analytic", "ipl_report", started)
@@ -0,0 +1,284 @@
+import datetime
+
+from typing import Dict, Any, List, Iterator, Set, Tuple
+from logging import getLogger
+
+import pandas
+
+from django.db import transaction
+from django.db.models import Max, Q, Subquery
+from django.utils import timezone
+
+from plugins.data import data_reader, data_writer
+from apps.sources.models import SipuniCall, Lead, TildaLead, AmocrmContact
+from apps.traffic.models import PhoneIndex, CallLeadMatch
+from apps.traffic.utils import normalize_phone
+
+from ._base import BaseCommand
+
+
+logger = getLogger(__name__)
+
+# Источник индекса: (модель, поля телефона, поле даты, фильтр записей)
+SOURCES = {
+    "call": (SipuniCall, ["call_from", "call_to"], "date", {}),
+    "lead": (Lead, ["phone"], "date_created", {}),
+    "tildalead": (TildaLead, ["phone"], "date_created", {}),
+    "contact": (AmocrmContact, ["phone"], "date_created", {"is_deleted": False}),
+}
+
+# Источники, с которыми сопоставляются звонки
+MATCH_SOURCES = ["lead", "tildalead", "contact"]
+
+STATE_FILENAME = "match_sipuni_calls_state.json"
+
+CHUNK_SIZE = 5000
+
+# Максимальный интервал между лидом и звонком
+WINDOW_DAYS = 30
+
+
+class Command(BaseCommand):
+    help = (
+        "Индекс телефонов и сопоставление звонков Sipuni с лидами, "
+        "tilda лидами и контактами"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Полное перестроение индекса и сопоставлений",
+        )
+        parser.add_argument(
+            "--window",
+            required=False,
+            type=int,
+            default=WINDOW_DAYS,
+            help="Максимальное количество дней между лидом и звонком",
+        )
+
+    def get_state(self) -> Dict[str, Any]:
+        try:
+            return data_reader.dict(STATE_FILENAME)
+        except FileNotFoundError:
+            return {}
+
+    def get_queryset(self, source: str):
+        model, _, _, filters = SOURCES.get(source)
+        return model.objects.filter(**filters)
+
+    def get_rows(
+        self, source: str, *args, **filters
+    ) -> Iterator[List[Dict[str, Any]]]:
+        _, phone_fields, date_field, _ = SOURCES.get(source)
+        queryset = (
+            self.get_queryset(source)
+            .filter(*args, **filters)
+            .order_by("pk")
+            .values_list("pk", date_field, *phone_fields)
+        )
+        chunk = []
+        for object_id, date, *phones in queryset.iterator(
+            chunk_size=CHUNK_SIZE
+        ):
+            for phone in set(map(normalize_phone, phones)) - {""}:
+                chunk.append(
+                    {
+                        "source": source,
+                        "object_id": object_id,
+                        "phone": phone,
+                        "date": date,
+                    }
+                )
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def update_index(self, source: str, full: bool = False):
+        """
+        Добавление в индекс записей источника, созданных после последней
+        проиндексированной, при full индекс источника строится заново
+        """
+        if full:
+            PhoneIndex.objects.filter(source=source).delete()
+        from_id = (
+            PhoneIndex.objects.filter(source=source)
+            .aggregate(value=Max("object_id"))
+            .get("value")
+            or 0
+        )
+        quantity = 0
+        for chunk in self.get_rows(source, pk__gt=from_id):
+            PhoneIndex.objects.bulk_create(
+                [PhoneIndex(**item) for item in chunk],
+                batch_size=1000,
+                ignore_conflicts=True,
+            )
+            quantity += len(chunk)
+        logger.info(
+            "  ↳ Index %(source)s: %(quantity)d"
+            % {"source": source, "quantity": quantity}
+        )
+
+    def purge(self, source: str) -> int:
+        """
+        Удаление из индекса и сопоставлений записей источника, которых
+        больше нет (удалены или объединены в источнике)
+        """
+        existing = Subquery(self.get_queryset(source).values("pk"))
+        quantity, _ = (
+            PhoneIndex.objects.filter(source=source)
+            .exclude(object_id__in=existing)
+            .delete()
+        )
+        if source == "call":
+            matches = CallLeadMatch.objects.exclude(call_id__in=existing)
+        else:
+            matches = CallLeadMatch.objects.filter(source=source).exclude(
+                lead_id__in=existing
+            )
+        removed, _ = matches.delete()
+        logger.info(
+            "  ↳ Purged %(source)s: %(quantity)d, matches: %(removed)d"
+            % {"source": source, "quantity": quantity, "removed": removed}
+        )
+        return quantity
+
+    def reindex_recent(self, source: str, since: datetime.datetime):
+        """
+        Переиндексация записей источника, созданных после since: телефон
+        лида или контакта может быть исправлен после добавления в индекс.
+        Для новых звонков важны только записи последних window дней
+        """
+        _, _, date_field, _ = SOURCES.get(source)
+        quantity = 0
+        for chunk in self.get_rows(source, **{f"{date_field}__gte": since}):
+            ids = set(item["object_id"] for item in chunk)
+            actual = dict(
+                ((item["object_id"], item["phone"]), item) for item in chunk
+            )
+            indexed: Set[Tuple[int, str]] = set(
+                PhoneIndex.objects.filter(
+                    source=source, object_id__in=ids
+                ).values_list("object_id", "phone")
+            )
+            stale = indexed - set(actual.keys())
+            missed = set(actual.keys()) - indexed
+            if not stale and not missed:
+                continue
+            with transaction.atomic():
+                for object_id, phone in stale:
+                    PhoneIndex.objects.filter(
+                        source=source, object_id=object_id, phone=phone
+                    ).delete()
+                    CallLeadMatch.objects.filter(
+                        source=source, lead_id=object_id, phone=phone
+                    ).delete()
+                PhoneIndex.objects.bulk_create(
+                    [PhoneIndex(**actual.get(key)) for key in missed],
+                    batch_size=1000,
+                    ignore_conflicts=True,
+                )
+            quantity += len(stale) + len(missed)
+        logger.info(
+            "  ↳ Reindexed %(source)s: %(quantity)d"
+            % {"source": source, "quantity": quantity}
+        )
+
+    def get_index(self, source: str, *args, **filters) -> pandas.DataFrame:
+        index = pandas.DataFrame(
+            PhoneIndex.objects.filter(
+                *args, source=source, date__isnull=False, **filters
+            )
+            .values("object_id", "phone", "date")
+            .iterator(chunk_size=CHUNK_SIZE),
+            columns=["object_id", "phone", "date"],
+        )
+        index["date"] = pandas.to_datetime(index["date"], utc=True)
+        return index.sort_values("date")
+
+    def match(
+        self, calls: pandas.DataFrame, source: str, window: int
+    ) -> List[CallLeadMatch]:
+        """
+        Каждому звонку, еще не сопоставленному с source, - ближайшая
+        предшествующая запись source с тем же телефоном не ранее window
+        дней до звонка
+        """
+        calls = calls[
+            ~calls["object_id"].isin(
+                set(
+                    CallLeadMatch.objects.filter(
+                        source=source,
+                        call_id__in=set(calls["object_id"].tolist()),
+                    ).values_list("call_id", flat=True)
+                )
+            )
+        ]
+        if calls.empty:
+            return []
+        leads = self.get_index(source, phone__in=set(calls["phone"]))
+        if leads.empty:
+            return []
+
+        matched = pandas.merge_asof(
+            calls,
+            leads.rename(columns={"object_id": "lead_id", "date": "date_lead"}),
+            left_on="date",
+            right_on="date_lead",
+            by="phone",
+            direction="backward",
+            tolerance=pandas.Timedelta(days=window),
+        ).dropna(subset=["lead_id"])
+        # Звонок с двумя проиндексированными номерами - ближайшая запись
+        matched = matched.sort_values("date_lead").drop_duplicates(
+            "object_id", keep="last"
+        )
+        return [
+            CallLeadMatch(
+                call_id=row.object_id,
+                source=source,
+                lead_id=int(row.lead_id),
+                phone=row.phone,
+                date_call=row.date.to_pydatetime(),
+                date_lead=row.date_lead.to_pydatetime(),
+            )
+            for row in matched.itertuples()
+        ]
+
+    def handle(self, full: bool = False, window: int = WINDOW_DAYS, **kwargs):
+        logger.info("Update phone index")
+        since = timezone.now() - datetime.timedelta(days=window)
+        for source in SOURCES.keys():
+            if not full:
+                self.purge(source)
+            self.update_index(source, full)
+        if not full:
+            for source in MATCH_SOURCES:
+                self.reindex_recent(source, since)
+
+        # Звонки, проверенные прошлыми запусками, перепроверяются только
+        # в пределах window: более старым новые записи не подходят
+        state = {} if full else self.get_state()
+        if full:
+            CallLeadMatch.objects.all().delete()
+        calls = self.get_index(
+            "call",
+            Q(object_id__gt=state.get("call_id", 0)) | Q(date__gte=since),
+        )
+        matches = []
+        for source in MATCH_SOURCES:
+            matches += self.match(calls, source, window)
+        with transaction.atomic():
+            CallLeadMatch.objects.bulk_create(
+                matches, batch_size=1000, ignore_conflicts=True
+            )
+        if not calls.empty:
+            call_id = max(int(calls["object_id"].max()), state.get("call_id", 0))
+            data_writer.dict({"call_id": call_id}, STATE_FILENAME)
+        logger.info(
+            "  ↳ Matched calls: %(quantity)d" % {"quantity": len(matches)}
+        )
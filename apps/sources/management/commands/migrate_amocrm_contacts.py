@@ -1,12 +1,12 @@
 import datetime
 
-from time import sleep
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 from logging import getLogger
 
 from django.db import transaction
 
-from plugins.amocrm.api import AmocrmAPIClient
+from plugins.data import data_reader, data_writer
+from plugins.amocrm.pagination import paginate
 
 from apps.sources.models import AmocrmContact
 
@@ -20,10 +20,47 @@ CUSTOM_FIELDS = {
     345807: "phone",
 }
 
+CHUNK_SIZE = 1000
+
+WATERMARK_FILENAME = "amocrm_contacts_watermark.json"
+
+# Период полного прохода при --incremental: изменения не содержат
+# удаленных контактов, их подхватывает только полный проход
+FULL_EVERY = datetime.timedelta(days=1)
+
 
 class Command(BaseCommand):
     help = "Сбор контактов из AmoCRM"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Только контакты, измененные после прошлого запуска "
+            "(полный проход не реже раза в сутки)",
+        )
+
+    def get_state(self) -> Dict[str, Any]:
+        try:
+            return data_reader.dict(WATERMARK_FILENAME)
+        except FileNotFoundError:
+            return {}
+
+    def get_watermark(self) -> Optional[int]:
+        state = self.get_state()
+        full_at = state.get("full_at")
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        if not full_at or full_at + FULL_EVERY.total_seconds() < now:
+            return
+        return state.get("updated_at")
+
+    def set_watermark(self, value: int, full_at: Optional[int] = None):
+        state = self.get_state()
+        state["updated_at"] = value
+        if full_at is not None:
+            state["full_at"] = full_at
+        data_writer.dict(state, WATERMARK_FILENAME)
+
     def prepare_data(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         contacts = []
         for item in items:
@@ -68,29 +105,29 @@ class Command(BaseCommand):
             )
         return contacts
 
-    def get_contacts(self, page: int = 1) -> List[Dict[str, Any]]:
-        logger.info("  ↳ Request API page: %(page)d" % {"page": page})
-        amocrm_api = AmocrmAPIClient()
-        sleep(1)
-        response = amocrm_api.contacts.get(page=page)
-        output = response.get("_embedded", {}).get("contacts", [])
-
-        next_link = response.get("_links", {}).get("next", {}).get("href")
-        if next_link:
-            next_page = int(response.get("_page")) + 1
-            output += self.get_contacts(next_page)
-
-        return output
-
-    def handle(self, **kwargs):
-        logger.info("Update all contacts")
-
-        response = self.get_contacts()
-        items = self.prepare_data(response)
-        logger.info(
-            "    ↳ Contacts quantity: %(quantity)d" % {"quantity": len(items)}
-        )
-
+    def get_contacts(
+        self, updated_from: Optional[int] = None
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Контакты пачками по CHUNK_SIZE по мере получения страниц,
+        при updated_from - только измененные начиная с этого времени
+        """
+        params = {}
+        if updated_from is not None:
+            params = {
+                "filter": {"updated_at": {"from_": updated_from}},
+                "order": {"updated_at": "asc"},
+            }
+        chunk = []
+        for items in paginate("contacts", "contacts", **params):
+            chunk += items
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def save_contacts(self, items: List[Dict[str, Any]]):
         items = dict([(item.get("amocrm_id"), item) for item in items])
 
         contacts_update_instances = AmocrmContact.objects.filter(
@@ -130,3 +167,35 @@ class Command(BaseCommand):
                     "phone",
                 ],
             )
+
+    def handle(self, incremental: bool = False, **kwargs):
+        watermark = self.get_watermark() if incremental else None
+        full = watermark is None
+        started = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        if full:
+            logger.info("Update all contacts")
+        else:
+            logger.info(
+                "Update contacts updated from: %(updated)s"
+                % {"updated": datetime.datetime.utcfromtimestamp(watermark)}
+            )
+
+        quantity = 0
+        for response in self.get_contacts(watermark):
+            items = self.prepare_data(response)
+            self.save_contacts(items)
+            quantity += len(items)
+            logger.info(
+                "    ↳ Contacts quantity: %(quantity)d" % {"quantity": quantity}
+            )
+            if not full:
+                updated = [
+                    item.get("updated_at") or 0 for item in response
+                ] + [watermark]
+                watermark = max(updated)
+                self.set_watermark(watermark)
+
+        # Полный проход сверяет все контакты, дальше достаточно изменений
+        # с момента его начала
+        if full:
+            self.set_watermark(started, full_at=started)
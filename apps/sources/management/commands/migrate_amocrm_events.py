@@ -0,0 +1,255 @@
+import datetime
+
+from typing import List, Dict, Any, Optional, Set
+from logging import getLogger
+
+from django.db import transaction
+from django.utils import timezone
+from django.core.management import call_command
+
+from plugins.data import data_reader, data_writer
+from plugins.amocrm.pagination import paginate
+
+from apps.sources.models import AmocrmLead, AmocrmUser
+
+from ._base import BaseCommand
+
+
+logger = getLogger(__name__)
+
+CURSOR_FILENAME = "amocrm_events_cursor.json"
+
+EVENT_TYPES = [
+    "lead_added",
+    "lead_deleted",
+    "lead_restored",
+    "lead_status_changed",
+    "entity_merged",
+]
+
+# Максимальный limit для /leads
+CHUNK_SIZE = 250
+
+# Время, на которое отступает первый запуск без курсора
+INITIAL_DEPTH = datetime.timedelta(hours=2)
+
+# Окно событий, курсор сдвигается только после применения всего окна
+WINDOW = datetime.timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = "Обновление сделок AmoCRM по ленте событий"
+
+    def get_cursor(self) -> Dict[str, Any]:
+        try:
+            return data_reader.dict(CURSOR_FILENAME)
+        except FileNotFoundError:
+            created_at = datetime.datetime.now(datetime.timezone.utc)
+            return {
+                "created_at": int((created_at - INITIAL_DEPTH).timestamp()),
+                "ids": [],
+            }
+
+    def set_cursor(self, created_at: int, ids: List[str]):
+        data_writer.dict(
+            {"created_at": created_at, "ids": ids}, CURSOR_FILENAME
+        )
+
+    def get_events(
+        self, cursor: Dict[str, Any], created_to: int
+    ) -> List[Dict[str, Any]]:
+        """
+        События сделок от курсора до created_to, от старых к новым.
+
+        /events отдает события от новых к старым, верхняя граница окна
+        не дает новым событиям сдвигать страницы во время получения
+        """
+        processed = set(cursor.get("ids", []))
+        events = []
+        for items in paginate(
+            "events_leads",
+            "events",
+            limit=100,
+            filter={
+                "entity": "lead",
+                "type_": EVENT_TYPES,
+                "created_at": {
+                    "from_": cursor.get("created_at"),
+                    "to_": created_to,
+                },
+            },
+        ):
+            events += [
+                item for item in items if item.get("id") not in processed
+            ]
+        events.sort(key=lambda item: (item.get("created_at"), item.get("id")))
+        logger.info(
+            "  ↳ Events quantity: %(quantity)d" % {"quantity": len(events)}
+        )
+        return events
+
+    def get_lead_ids(self, events: List[Dict[str, Any]]) -> Set[int]:
+        return set(
+            int(event.get("entity_id"))
+            for event in events
+            if event.get("entity_type") == "lead" and event.get("entity_id")
+        )
+
+    def get_leads(self, ids: Set[int]) -> List[Dict[str, Any]]:
+        ids = sorted(ids)
+        leads = []
+        for index in range(0, len(ids), CHUNK_SIZE):
+            for items in paginate(
+                "leads",
+                "leads",
+                limit=CHUNK_SIZE,
+                prefetch=1,
+                filter={"id": ids[index : index + CHUNK_SIZE]},
+            ):
+                leads += items
+        return leads
+
+    def parse_timestamp(
+        self, value: Optional[int]
+    ) -> Optional[datetime.datetime]:
+        if not value:
+            return
+        return datetime.datetime.utcfromtimestamp(value).replace(
+            tzinfo=datetime.timezone.utc
+        )
+
+    def prepare_data(
+        self, items: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        users = dict((user.amocrm_id, user) for user in AmocrmUser.objects.all())
+        return [
+            {
+                "amocrm_id": int(item.get("id")),
+                "name": item.get("name", "") or "",
+                "price": item.get("price") or 0,
+                "status_id": item.get("status_id"),
+                "pipeline_id": item.get("pipeline_id"),
+                "responsible_user": users.get(item.get("responsible_user_id")),
+                "date_created": self.parse_timestamp(item.get("created_at")),
+                "date_updated": self.parse_timestamp(item.get("updated_at")),
+                "date_closed": self.parse_timestamp(item.get("closed_at")),
+                "is_deleted": item.get("is_deleted", False) or False,
+            }
+            for item in items
+        ]
+
+    def save_leads(self, items: List[Dict[str, Any]]):
+        """
+        Обновление состояния сохраненных сделок, остальные поля (utm,
+        roistat_url) заполняет импорт migrate_amocrm_leads и не меняются
+        """
+        items = dict([(item.get("amocrm_id"), item) for item in items])
+        fields = [
+            "name",
+            "price",
+            "status_id",
+            "pipeline_id",
+            "responsible_user",
+            "date_created",
+            "date_updated",
+            "date_closed",
+            "is_deleted",
+        ]
+
+        update_instances = list(
+            AmocrmLead.objects.filter(amocrm_id__in=items.keys())
+        )
+        for instance in update_instances:
+            for field in fields:
+                setattr(
+                    instance, field, items.get(instance.amocrm_id).get(field)
+                )
+
+        with transaction.atomic():
+            AmocrmLead.objects.bulk_update(
+                update_instances, fields, batch_size=1000
+            )
+        logger.info(
+            "    ↳ Updated: %(quantity)d" % {"quantity": len(update_instances)}
+        )
+
+    def import_leads(self, items: List[Dict[str, Any]]):
+        """
+        Новые сделки читаются существующим импортом migrate_amocrm_leads
+        с даты создания самой ранней из них, чтобы все поля (utm,
+        roistat_url) заполнялись так же, как при полном импорте
+        """
+        dates = [
+            timezone.localtime(self.parse_timestamp(item.get("created_at"))).date()
+            for item in items
+            if item.get("created_at")
+        ]
+        date_from = min(dates, default=timezone.localdate())
+        logger.info(
+            "    ↳ New leads: %(quantity)d, import from: %(date)s"
+            % {"quantity": len(items), "date": date_from}
+        )
+        call_command("migrate_amocrm_leads", date_from=str(date_from))
+
+    def delete_leads(self, ids: Set[int]):
+        """
+        Сделки, удаленные в amoCRM или поглощенные при слиянии: при
+        объединении для поглощенных сделок приходит lead_deleted, и они
+        больше не отдаются /leads
+        """
+        quantity = AmocrmLead.objects.filter(
+            amocrm_id__in=ids, is_deleted=False
+        ).update(is_deleted=True)
+        logger.info("    ↳ Deleted: %(quantity)d" % {"quantity": quantity})
+
+    def apply_events(self, events: List[Dict[str, Any]]):
+        # Создание, смена статуса, слияние и удаление одинаково
+        # обрабатываются перечитыванием итогового состояния сделки
+        lead_ids = self.get_lead_ids(events)
+        leads = self.get_leads(lead_ids)
+        existing = set(
+            AmocrmLead.objects.filter(amocrm_id__in=lead_ids).values_list(
+                "amocrm_id", flat=True
+            )
+        )
+        self.save_leads(
+            self.prepare_data(
+                [item for item in leads if int(item.get("id")) in existing]
+            )
+        )
+        created = [item for item in leads if int(item.get("id")) not in existing]
+        if created:
+            self.import_leads(created)
+        missed = lead_ids - set(int(item.get("id")) for item in leads)
+        if missed:
+            self.delete_leads(missed)
+
+    def handle(self, **kwargs):
+        cursor = self.get_cursor()
+        logger.info(
+            "Update amocrm leads by events from: %(created_at)s"
+            % {"created_at": self.parse_timestamp(cursor.get("created_at"))}
+        )
+
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        while True:
+            created_to = min(
+                cursor.get("created_at") + int(WINDOW.total_seconds()), now
+            )
+            events = self.get_events(cursor, created_to)
+            if events:
+                self.apply_events(events)
+
+            # События секунды created_to могут прийти позже, их id
+            # сохраняются, чтобы не применять повторно
+            ids = [
+                event.get("id")
+                for event in events
+                if event.get("created_at") == created_to
+            ]
+            if created_to == cursor.get("created_at"):
+                ids += cursor.get("ids", [])
+            cursor = {"created_at": created_to, "ids": ids}
+            self.set_cursor(created_to, ids)
+            if created_to >= now:
+                break
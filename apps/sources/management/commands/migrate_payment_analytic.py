@@ -15,16 +15,34 @@ from apps.choices import PaymentAnalyticType, RoistatDimensionType, UserGroup
 from apps.sources.models import PaymentAnalytic, RoistatDimension, AmocrmLead
 from plugins.webhooks.workers import WebhookWorker
 
-from plugins.google.sheets import SheetsAPIClient
+from plugins.google.snapshot import SnapshotSheetsAPIClient
 
 from ._base import BaseCommand
+from ._metrics import MetricsMixin
 
 logger = getLogger(__name__)
 
+# Колонки листа "Все оплаты", которые читают migrate_payment_analytic и
+# update_payment_analytic, сверяются по всему листу при дочитывании
+PAYMENTS_COLUMNS = [
+    "Почта",
+    "Ссылка на amocrm",
+    "Менеджер",
+    "Гр",
+    "Сумма выручки",
+    "Дата создания сделки",
+    "Дата последней заявки (платной)",
+    "Дата оплаты",
+    "Дата zoom",
+    "Месяц / Доплата",
+    "Курс",
+    "Целевая ссылка",
+]
+
 User = get_user_model()
 
 
-class Command(BaseCommand):
+class Command(MetricsMixin, BaseCommand):
     help = 'Сбор данных из таблицы "Аналитика по оплатам"'
 
     users: Dict[str, User]
@@ -113,9 +131,12 @@ class Command(BaseCommand):
 
     def get_payments(self) -> pandas.DataFrame:
         logger.info("  ↳ Request API")
-        sheets_api = SheetsAPIClient()
-        worksheet = sheets_api.payments_analytic.worksheet("Все оплаты")
-        values = worksheet.get_all_values()
+        sheets_api = SnapshotSheetsAPIClient()
+        spreadsheet = sheets_api.payments_analytic
+        with self.metrics.track(sheets_api.get_session(spreadsheet)):
+            values = sheets_api.get_appended_values(
+                spreadsheet, "Все оплаты", PAYMENTS_COLUMNS
+            )
         data = pandas.DataFrame(data=values[1:], columns=values[0])
         logger.info("    ↳ Quantity: %(quantity)d" % {"quantity": len(data)})
         return data
@@ -338,12 +359,18 @@ class Command(BaseCommand):
     def handle(self, **kwargs):
         logger.info("Update payment analytic")
 
-        payments = self.get_payments()
-        data = self.prepare_data(payments)
+        with self.metrics.stage("load") as stage:
+            payments = self.get_payments()
+            stage["rows_out"] = len(payments)
+        with self.metrics.stage("prepare", rows_in=len(payments)) as stage:
+            data = self.prepare_data(payments)
+            stage["rows_out"] = len(data)
 
-        data_new = self.get_diff(data)
+        with self.metrics.stage("diff", rows_in=len(data)) as stage:
+            data_new = self.get_diff(data)
+            stage["rows_out"] = len(data_new)
 
-        with transaction.atomic():
+        with self.metrics.stage("save", rows_in=len(data)), transaction.atomic():
             PaymentAnalytic.objects.all().delete()
             instances = self.get_instances(data)
             PaymentAnalytic.objects.bulk_create(instances, batch_size=1000)
@@ -1,24 +1,44 @@
 import pytz
 import datetime
 
-from time import sleep
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple, Iterator, Set
 from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from django.db import transaction
 from django.conf import settings
+from django.core.management import call_command
 
 from apps.sources.models import RoistatAnalytic, RoistatDimension
+from apps.traffic.models import ExpensesDaily
 
+from plugins.ratelimit import TokenBucket
 from plugins.roistat.api import RoistatAPIClient
 
 from ._base import BaseCommand
+from ._changes import mark_changed
 
 
 logger = getLogger(__name__)
 
 ANALYTIC_TZ = pytz.timezone(settings.ANALYTIC_TIME_ZONE)
 
+# Количество дней в одном запросе analytic
+WINDOW_DAYS = 10
+
+limiter = TokenBucket(1)
+
+KEY_DIMENSIONS = [
+    "landing_page",
+    "marker_level_1",
+    "marker_level_2",
+    "marker_level_3",
+    "marker_level_4",
+    "marker_level_5",
+    "marker_level_6",
+    "marker_level_7",
+]
+
 
 class Command(BaseCommand):
     help = "Сбор аналитики из Roistat"
@@ -51,14 +71,41 @@ class Command(BaseCommand):
         parser.add_argument(
             "-dt", "--date-to", required=False, type=self.parse_date
         )
+        parser.add_argument(
+            "--window",
+            required=False,
+            type=int,
+            default=WINDOW_DAYS,
+            help="Количество дней в одном запросе",
+        )
+        parser.add_argument(
+            "--workers",
+            required=False,
+            type=int,
+            default=1,
+            help="Количество одновременных запросов",
+        )
+
+    def parse_interval_date(
+        self, value: Dict[str, Any]
+    ) -> Optional[datetime.date]:
+        date_from = value.get("dateFrom")
+        if not date_from:
+            return
+        return datetime.date.fromisoformat(str(date_from)[:10])
 
-    def get_api_data(self, date: datetime.date) -> List[Dict[str, Any]]:
+    def get_api_data(
+        self, date_from: datetime.date, date_to: datetime.date
+    ) -> Dict[datetime.date, List[Dict[str, Any]]]:
         """
-        Получение данных из api
+        Получение данных из api за период, с разбивкой по дням
         """
-        logger.info("  ↳ Request API: %(date)s" % {"date": date})
+        logger.info(
+            "  ↳ Request API: %(from)s <-> %(to)s"
+            % {"from": date_from, "to": date_to}
+        )
+        limiter.acquire()
         roistat_api = RoistatAPIClient()
-        sleep(1)
         response = roistat_api.analytic.post(
             dimensions=[
                 "landing_page",
@@ -73,57 +120,170 @@ class Command(BaseCommand):
             metrics=["visitsCost"],
             period={
                 "from_": ANALYTIC_TZ.localize(
-                    datetime.datetime.combine(date, datetime.time.min)
+                    datetime.datetime.combine(date_from, datetime.time.min)
                 ),
                 "to_": ANALYTIC_TZ.localize(
-                    datetime.datetime.combine(date, datetime.time.max)
+                    datetime.datetime.combine(date_to, datetime.time.max)
                 ),
             },
             filters=[{"field": "visitsCost", "operator": ">", "value": "0"}],
             interval="1d",
         )
-        items = response.get("data", [{}])[0].get("items", [])
-        logger.info("    ↳ Quantity: %(quantity)d" % {"quantity": len(items)})
-        return items
+        output = {}
+        for index, interval in enumerate(response.get("data", [])):
+            date = self.parse_interval_date(interval) or (
+                date_from + datetime.timedelta(days=index)
+            )
+            output[date] = interval.get("items", [])
+        logger.info(
+            "    ↳ Quantity: %(quantity)d"
+            % {"quantity": sum(len(items) for items in output.values())}
+        )
+        return output
 
     def filter_metrics(self, value: Dict[str, Any]) -> bool:
         return value.get("metric_name") == "visitsCost"
 
-    def get_analytic(
-        self, date_from: datetime.date, date_to: datetime.date
+    def prepare_data(
+        self, date: datetime.date, items: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
-        """
-        Функция сборки записей целиком за период
-        """
         data = []
+        for item in items:
+            metrics = list(filter(self.filter_metrics, item.get("metrics", [])))
+            expenses = float(metrics[0].get("value", 0) if metrics else 0)
+            dimensions = dict(
+                [
+                    (
+                        f"dimension_{dimension}",
+                        self.dimensions.get(value.get("value"), {}).get(
+                            dimension, [None]
+                        )[0]
+                        or None,
+                    )
+                    for dimension, value in item.get("dimensions", {}).items()
+                ]
+            )
+            dimensions.update({"date": date, "expenses": expenses})
+            data.append(dimensions)
+        return data
+
+    def get_windows(
+        self, date_from: datetime.date, date_to: datetime.date, window: int
+    ) -> List[Tuple[datetime.date, datetime.date]]:
+        windows = []
         while date_from <= date_to:
-            items = self.get_api_data(date_from)
-            for item in items:
-                metrics = list(
-                    filter(self.filter_metrics, item.get("metrics", []))
-                )
-                expenses = float(metrics[0].get("value", 0) if metrics else 0)
-                dimensions = dict(
-                    [
-                        (
-                            f"dimension_{dimension}",
-                            self.dimensions.get(value.get("value"), {}).get(
-                                dimension, [None]
-                            )[0]
-                            or None,
-                        )
-                        for dimension, value in item.get(
-                            "dimensions", {}
-                        ).items()
-                    ]
+            window_to = min(
+                date_from + datetime.timedelta(days=window - 1), date_to
+            )
+            windows.append((date_from, window_to))
+            date_from = window_to + datetime.timedelta(days=1)
+        return windows
+
+    def get_analytic(
+        self,
+        date_from: datetime.date,
+        date_to: datetime.date,
+        window: int = WINDOW_DAYS,
+        workers: int = 1,
+    ) -> Iterator[Tuple[datetime.date, datetime.date, List[Dict[str, Any]]]]:
+        """
+        Записи по окнам в window дней, окна отдаются по мере получения
+        """
+        windows = self.get_windows(date_from, date_to, max(window, 1))
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = dict(
+                (executor.submit(self.get_api_data, *item), item)
+                for item in windows
+            )
+            for future in as_completed(futures):
+                window_from, window_to = futures[future]
+                data = []
+                for date, items in future.result().items():
+                    data += self.prepare_data(date, items)
+                yield window_from, window_to, data
+
+    def get_key(self, item: Dict[str, Any]) -> tuple:
+        return (item["date"],) + tuple(
+            getattr(item.get(f"dimension_{dimension}"), "pk", None)
+            for dimension in KEY_DIMENSIONS
+        )
+
+    def save_analytic(
+        self,
+        date_from: datetime.date,
+        date_to: datetime.date,
+        analytic: List[Dict[str, Any]],
+    ) -> Set[datetime.date]:
+        """
+        Запись окна только измененными строками, возвращает измененные даты
+        """
+        items = {}
+        for item in analytic:
+            key = self.get_key(item)
+            if key in items:
+                items[key]["expenses"] += item["expenses"]
+            else:
+                items[key] = item
+
+        existing = {}
+        delete_ids = []
+        changed = set()
+        for row in RoistatAnalytic.objects.filter(
+            date__gte=date_from, date__lte=date_to
+        ).values(
+            "id",
+            "date",
+            "expenses",
+            *[f"dimension_{dimension}_id" for dimension in KEY_DIMENSIONS],
+        ):
+            key = (row["date"],) + tuple(
+                row[f"dimension_{dimension}_id"] for dimension in KEY_DIMENSIONS
+            )
+            if key in existing or key not in items:
+                delete_ids.append(row["id"])
+                changed.add(row["date"])
+            else:
+                existing[key] = row
+
+        create_instances = []
+        update_instances = []
+        for key, item in items.items():
+            row = existing.get(key)
+            if row is None:
+                create_instances.append(RoistatAnalytic(**item))
+                changed.add(key[0])
+            elif round(float(row["expenses"]), 2) != round(item["expenses"], 2):
+                update_instances.append(
+                    RoistatAnalytic(id=row["id"], **item)
                 )
-                dimensions.update({"date": date_from, "expenses": expenses})
-                data.append(dimensions)
-            date_from += datetime.timedelta(days=1)
-        return data
+                changed.add(key[0])
+
+        with transaction.atomic():
+            RoistatAnalytic.objects.filter(pk__in=delete_ids).delete()
+            RoistatAnalytic.objects.bulk_create(
+                create_instances, batch_size=1000
+            )
+            RoistatAnalytic.objects.bulk_update(
+                update_instances, ["expenses"], batch_size=1000
+            )
+        logger.info(
+            "    ↳ Created: %(created)d, updated: %(updated)d, "
+            "deleted: %(deleted)d"
+            % {
+                "created": len(create_instances),
+                "updated": len(update_instances),
+                "deleted": len(delete_ids),
+            }
+        )
+        return changed
 
     def handle(
-        self, date_from: datetime.date, date_to: datetime.date = None, **kwargs
+        self,
+        date_from: datetime.date,
+        date_to: datetime.date = None,
+        window: int = WINDOW_DAYS,
+        workers: int = 1,
+        **kwargs,
     ):
         if date_to is None:
             date_to = datetime.datetime.now().astimezone(ANALYTIC_TZ).date()
@@ -138,11 +298,14 @@ class Command(BaseCommand):
             % {"from": date_from, "to": date_to}
         )
 
-        analytic = self.get_analytic(date_from, date_to)
+        # ExpensesDaily заполняется целиком при первом запуске после
+        # создания таблицы, дальше пересчитываются только измененные дни
+        if not ExpensesDaily.objects.exists():
+            call_command("refresh_expenses_daily")
 
-        with transaction.atomic():
-            RoistatAnalytic.objects.filter(
-                date__gte=date_from, date__lte=date_to
-            ).delete()
-            instances = [RoistatAnalytic(**item) for item in analytic]
-            RoistatAnalytic.objects.bulk_create(instances, batch_size=1000)
+        for window_from, window_to, analytic in self.get_analytic(
+            date_from, date_to, window, workers
+        ):
+            changed = self.save_analytic(window_from, window_to, analytic)
+            ExpensesDaily.objects.refresh(changed)
+            mark_changed("roistat_analytic", changed)
@@ -2,35 +2,67 @@ import pytz
 import hashlib
 import datetime
 from logging import getLogger
+from collections import Counter
+from typing import Dict, Any, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import pandas
-from io import BytesIO
+from requests.adapters import HTTPAdapter
 
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, connection
+from django.core.management.base import CommandError
 
 from apps.sources.models import SipuniCall
+from apps.traffic.utils import normalize_phone
+from plugins.data import data_reader, data_writer
 from ._base import BaseCommand
 
 logger = getLogger(__name__)
 
+CALLS_TZ = pytz.timezone('Europe/Moscow')
+
+# Количество строк csv, обрабатываемых за раз
+CHUNK_SIZE = 5000
+
+STATUS_FILENAME = 'sipuni_calls_days.json'
+
+UPDATE_FIELDS = ['type', 'status', 'line', 'time_answer', 'dialing']
+
 
 class Command(BaseCommand):
     help = "Сбор данных звонков"
 
+    session: requests.Session
+
     # Аргументы для команды django
     def add_arguments(self, parser):
         parser.add_argument(
-            "-df", "--date-from", required=True, type=self.parse_date
+            "-df", "--date-from", required=False, type=self.parse_date
         )
         parser.add_argument(
             "-dt", "--date-to", required=False, type=self.parse_date
         )
+        parser.add_argument(
+            "--workers", required=False, type=int, default=4,
+            help="Количество дней, загружаемых одновременно",
+        )
+        parser.add_argument(
+            "--retry-failed", action="store_true",
+            help="Повторная загрузка только дней, завершившихся ошибкой",
+        )
 
     def parse_date(self, value: str) -> datetime.date:
         return datetime.date.fromisoformat(value)
 
-    def get_response(self, df: datetime.date, dt: datetime.date) -> pandas.DataFrame:
+    def get_session(self, workers: int) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_response(self, df: datetime.date, dt: datetime.date) -> requests.Response:
 
         hash_dict = {
             'anonymous': '1',
@@ -56,10 +88,10 @@ class Command(BaseCommand):
         hash = hashlib.md5(hash_string.encode()).hexdigest()
         hash_dict.update({'hash': hash})
 
-        response = requests.post(settings.SIPUNI_API_URL, data=hash_dict)
-        response_df: pandas.DataFrame = pandas.read_csv(BytesIO(response.content), delimiter=';', encoding='utf-8',
-                                                        header=0)
-        return response_df
+        response = self.session.post(settings.SIPUNI_API_URL, data=hash_dict, stream=True, timeout=300)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response
 
     def prepare_data(self, response_df: pandas.DataFrame) -> pandas.DataFrame:
         response_df = response_df[
@@ -75,7 +107,123 @@ class Command(BaseCommand):
         prepared_df: pandas.DataFrame = response_df.fillna(0)
         return prepared_df
 
-    def handle(self, date_from: datetime.date, date_to: datetime.date = None, **kwargs):
+    def get_phone(self, value: Any) -> str:
+        """
+        Номер для ключа звонка: E.164 для телефонов, как есть для
+        внутренних номеров; pandas читает номера как float при пропусках
+        """
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        value = str(value).strip()
+        return normalize_phone(value) or value
+
+    def get_duration(self, value: Any) -> int:
+        return int(float(value or 0))
+
+    def get_key(self, item: Dict[str, Any]) -> tuple:
+        """
+        Ключ звонка без номера повтора: время, номера и длительности
+        """
+        return (
+            item['date'],
+            self.get_phone(item['call_from']),
+            self.get_phone(item['call_to']),
+            self.get_duration(item['time_call']),
+            self.get_duration(item['time_talk']),
+        )
+
+    def get_keys(self, items: List[Dict[str, Any]], counter: Counter) -> List[tuple]:
+        """
+        Ключи звонков с номером повтора: перезвоны и переводы между теми же
+        номерами в ту же секунду различаются порядком в выгрузке (в базе -
+        порядком pk), counter продолжает нумерацию между пачками дня
+        """
+        keys = []
+        for item in items:
+            key = self.get_key(item)
+            keys.append(key + (counter[key],))
+            counter[key] += 1
+        return keys
+
+    def get_day_range(self, date: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+        return (
+            CALLS_TZ.localize(datetime.datetime.combine(date, datetime.time.min)),
+            CALLS_TZ.localize(datetime.datetime.combine(date, datetime.time.max)),
+        )
+
+    def save_chunk(self, date: datetime.date, records: List[Dict[str, Any]], counter: Counter) -> Set[tuple]:
+        """
+        Запись пачки звонков по ключу (время, откуда, куда, длительности,
+        номер повтора), возвращает ключи записей
+        """
+        for record in records:
+            record['date'] = record['date'].to_pydatetime()
+        items = dict(zip(self.get_keys(records, counter), records))
+
+        # Сохраненные номера могут быть в другом формате, поиск по времени
+        instances = list(
+            SipuniCall.objects.filter(
+                date__range=self.get_day_range(date),
+                date__in=set(key[0] for key in items),
+            ).order_by('pk')
+        )
+        existing = dict(zip(self.get_keys([item.__dict__ for item in instances], Counter()), instances))
+
+        update_instances = []
+        for key, instance in existing.items():
+            item = items.get(key)
+            if item is None:
+                continue
+            for field in UPDATE_FIELDS:
+                setattr(instance, field, item[field])
+            update_instances.append(instance)
+        create_instances = [SipuniCall(**item) for key, item in items.items() if key not in existing]
+
+        with transaction.atomic():
+            SipuniCall.objects.bulk_create(create_instances, batch_size=1000)
+            SipuniCall.objects.bulk_update(update_instances, UPDATE_FIELDS, batch_size=1000)
+        return set(items.keys())
+
+    def process_day(self, date: datetime.date) -> int:
+        response = self.get_response(date, date)
+        keys = set()
+        counter = Counter()
+        quantity = 0
+        try:
+            reader = pandas.read_csv(response.raw, delimiter=';', encoding='utf-8', header=0,
+                                     chunksize=CHUNK_SIZE)
+        except pandas.errors.EmptyDataError:
+            reader = []
+        for chunk in reader:
+            records = self.prepare_data(chunk).to_dict(orient='records')
+            keys |= self.save_chunk(date, records, counter)
+            quantity += len(records)
+        # Звонки дня, которых больше нет в выгрузке
+        instances = list(SipuniCall.objects.filter(date__range=self.get_day_range(date)).order_by('pk'))
+        delete_ids = [
+            instance.pk
+            for key, instance in zip(self.get_keys([item.__dict__ for item in instances], Counter()), instances)
+            if key not in keys
+        ]
+        SipuniCall.objects.filter(pk__in=delete_ids).delete()
+        return quantity
+
+    def process_day_in_thread(self, date: datetime.date) -> int:
+        # Соединение с БД потока пула закрывается после дня, соединение
+        # основного потока не трогается
+        try:
+            return self.process_day(date)
+        finally:
+            connection.close()
+
+    def get_statuses(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            return data_reader.dict(STATUS_FILENAME)
+        except FileNotFoundError:
+            return {}
+
+    def handle(self, date_from: datetime.date = None, date_to: datetime.date = None, workers: int = 4,
+               retry_failed: bool = False, **kwargs):
         tz = pytz.timezone(settings.ANALYTIC_TIME_ZONE)
         if date_to is None:
             date_to = datetime.datetime.now().astimezone(tz).date()
@@ -83,22 +231,28 @@ class Command(BaseCommand):
             date_from = self.parse_date(date_from)
         if isinstance(date_to, str):
             date_to = self.parse_date(date_to)
-        db_list = []
-        select_date = date_from
-        while select_date <= date_to:
-            try:
-                response_df = self.get_response(select_date, select_date)
-                result: pandas.DataFrame = self.prepare_data(response_df)
-                db_list.extend(result.to_dict(orient='records'))
-            except Exception:
-                print('Ошибка данных сипуни')
-            finally:
-                select_date += datetime.timedelta(days=1)
-        with transaction.atomic():
-            if db_list:
-                SipuniCall.objects.filter(
-                    date__gte=datetime.datetime.combine(date_from, datetime.datetime.min.time()),
-                    date__lte=datetime.datetime.combine(date_to, datetime.datetime.max.time())
-                ).delete()
-                instances = [SipuniCall(**item) for item in db_list]
-                SipuniCall.objects.bulk_create(instances, batch_size=1000)
+
+        statuses = self.get_statuses()
+        if retry_failed:
+            dates = sorted(
+                self.parse_date(key) for key, value in statuses.items() if value.get('status') == 'error'
+            )
+        else:
+            if date_from is None:
+                raise CommandError('--date-from is required')
+            dates = [date_from + datetime.timedelta(days=days) for days in range((date_to - date_from).days + 1)]
+        logger.info("Update sipuni calls, days: %(quantity)d" % {"quantity": len(dates)})
+
+        self.session = self.get_session(workers)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = dict((executor.submit(self.process_day_in_thread, date), date) for date in dates)
+            for future in as_completed(futures):
+                date = futures[future]
+                try:
+                    quantity = future.result()
+                    statuses[date.isoformat()] = {'status': 'ok', 'quantity': quantity}
+                    logger.info("  ↳ %(date)s: %(quantity)d" % {"date": date, "quantity": quantity})
+                except Exception as error:
+                    statuses[date.isoformat()] = {'status': 'error', 'error': str(error)}
+                    logger.error("  ↳ %(date)s: %(error)s" % {"date": date, "error": error})
+                data_writer.dict(statuses, STATUS_FILENAME)
@@ -0,0 +1,48 @@
+import datetime
+
+from logging import getLogger
+
+from apps.sources.models import RoistatAnalytic
+from apps.traffic.models import ExpensesDaily
+
+from ._base import BaseCommand
+
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Пересчет таблицы расходов по дням"
+
+    def parse_date(self, value: str) -> datetime.date:
+        return datetime.date.fromisoformat(value)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-df", "--date-from", required=False, type=self.parse_date
+        )
+        parser.add_argument(
+            "-dt", "--date-to", required=False, type=self.parse_date
+        )
+
+    def handle(
+        self,
+        date_from: datetime.date = None,
+        date_to: datetime.date = None,
+        **kwargs
+    ):
+        dates = set()
+        for model in [RoistatAnalytic, ExpensesDaily]:
+            queryset = model.objects.all()
+            if date_from:
+                queryset = queryset.filter(date__gte=date_from)
+            if date_to:
+                queryset = queryset.filter(date__lte=date_to)
+            dates.update(queryset.values_list("date", flat=True).distinct())
+        dates = sorted(dates)
+        logger.info(
+            "Refresh expenses daily, days: %(quantity)d"
+            % {"quantity": len(dates)}
+        )
+        for index in range(0, len(dates), 30):
+            ExpensesDaily.objects.refresh(dates[index : index + 30])
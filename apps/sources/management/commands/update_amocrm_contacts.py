@@ -1,73 +1,108 @@
 import datetime
 import pytz
 
+from typing import Any, Dict, Iterator
 from logging import getLogger
 
 from django.db import transaction
 
 from apps.sources.models import PaymentAnalytic, AmocrmContact, AmocrmUser
 from apps.sources.management.commands._base import BaseCommand
-from plugins.amocrm.api import AmocrmAPIClient
 from plugins.amocrm.api.exceptions import AmocrmAPIException
+from plugins.amocrm.pagination import paginate
 
 logger = getLogger(__name__)
 
+# Максимальный limit списочных методов amoCRM v4
+CHUNK_SIZE = 250
+
 
 class Command(BaseCommand):
     help = "Обновление контактов AmoCRM"
 
     def get_difference_ids(self) -> list:
         logger.info("  ↳ Get difference ids started")
-        pyment_ids = list(set(PaymentAnalytic.objects.values_list('amocrm_id', flat=True)))
-        contacts_ids = list(set(AmocrmContact.objects.values_list('amocrm_id', flat=True)))
-        difference_ids = [ids for ids in pyment_ids if ids not in contacts_ids]
+        pyment_ids = set(PaymentAnalytic.objects.values_list('amocrm_id', flat=True))
+        contacts_ids = set(AmocrmContact.objects.values_list('amocrm_id', flat=True))
+        difference_ids = list(pyment_ids - contacts_ids)
         logger.info("    ↳ New contacts: %(quantity)d" % {"quantity": len(difference_ids)})
         return difference_ids
 
+    def get_chunks(self, ids: list) -> Iterator[list]:
+        numeric = []
+        for item in ids:
+            value = str(item or '').strip()
+            if not value:
+                continue
+            if not value.isdigit():
+                logger.warning(f"    ↳ Invalid amocrm id: {item} - Ignored...")
+                continue
+            numeric.append(int(value))
+        ids = numeric
+        for index in range(0, len(ids), CHUNK_SIZE):
+            yield ids[index:index + CHUNK_SIZE]
+
+    def get_lead_contacts(self, ids: list) -> Dict[int, int]:
+        """
+        Основной контакт каждой сделки, запросы пачками по CHUNK_SIZE id
+        """
+        lead_contacts = {}
+        for chunk in self.get_chunks(ids):
+            try:
+                for leads in paginate("leads", "leads", limit=CHUNK_SIZE, prefetch=1,
+                                      filter={"id": chunk}, with_=["contacts"]):
+                    for lead in leads:
+                        contacts = lead.get('_embedded', {}).get('contacts', []) or []
+                        contact = next((item for item in contacts if item.get('is_main')), None)
+                        if contact is None and contacts:
+                            contact = contacts[0]
+                        if contact is not None:
+                            lead_contacts[int(lead.get('id'))] = int(contact.get('id'))
+            except AmocrmAPIException:
+                logger.warning(f"    ↳ Invalid response. Leads ids: {chunk[0]}..{chunk[-1]} - Ignored...")
+        return lead_contacts
+
+    def get_contacts(self, ids: list) -> Dict[int, Dict[str, Any]]:
+        contacts = {}
+        for chunk in self.get_chunks(list(set(ids))):
+            try:
+                for items in paginate("contacts", "contacts", limit=CHUNK_SIZE, prefetch=1,
+                                      filter={"id": chunk}):
+                    contacts.update(dict((int(item.get('id')), item) for item in items))
+            except AmocrmAPIException:
+                logger.warning(f"    ↳ Invalid response. Contacts ids: {chunk[0]}..{chunk[-1]} - Ignored...")
+        return contacts
+
+    def get_custom_field(self, response_data: Dict[str, Any], code: str) -> str:
+        entry = next((entry for entry in response_data.get('custom_fields_values', []) or [] if
+                      entry.get('field_code') == code), {})
+        return entry.get('values', [{}])[0].get('value', '')
+
     def update_amocrm_contact(self, ids: list):
         logger.info("  ↳ Get new amoCRM contact started")
+        users = dict((user.amocrm_id, user) for user in AmocrmUser.objects.all())
+        lead_contacts = self.get_lead_contacts(ids)
+        contacts = self.get_contacts(list(lead_contacts.values()))
+        moscow_timezone = pytz.timezone('Europe/Moscow')
         contacts_objects = []
-        for id_lead in ids:
-            amocrm_api_lead_links = AmocrmAPIClient(to_entity_id=id_lead)
-            response = amocrm_api_lead_links.lead_links.get()
-            links = response.get('_embedded', {}).get('links', [])
-            if links:
-                contact_id = links[0].get('to_entity_id')
-                if contact_id is not None:
-                    amocrm_api_contact = AmocrmAPIClient(contact_id=contact_id)
-                    try:
-                        response_data = amocrm_api_contact.contact.get()
-                    except AmocrmAPIException as error:
-                        logger.warning(f"    ↳ Invalid response. Contact id: {contact_id}, Lead id {id_lead} - Ignored...")
-                        continue
-                    if response_data:
-                        name = response_data.get('name', '')
-                        responsible_user_id = response_data.get('responsible_user_id', '')
-                        is_deleted = response_data.get('is_deleted', '')
-                        created_at_timestamp = int(response_data.get('created_at', 0))
-                        updated_at_timestamp = int(response_data.get('updated_at', 0))
-                        moscow_timezone = pytz.timezone('Europe/Moscow')
-                        created_at = datetime.datetime.fromtimestamp(created_at_timestamp, tz=moscow_timezone)
-                        updated_at = datetime.datetime.fromtimestamp(updated_at_timestamp, tz=moscow_timezone)
-                        phone_entry = next((entry for entry in response_data.get('custom_fields_values', []) if
-                                            entry.get('field_code') == 'PHONE'), {})
-                        phone_value = phone_entry.get('values', [{}])[0].get('value', '')
-                        email_entry = next((entry for entry in response_data.get('custom_fields_values', []) if
-                                            entry.get('field_code') == 'EMAIL'), {})
-                        email_value = email_entry.get('values', [{}])[0].get('value', '')
-
-                        amocrm_contact = AmocrmContact(
-                            date_created=created_at,
-                            date_updated=updated_at,
-                            name=name,
-                            responsible_user=AmocrmUser.objects.filter(amocrm_id=id_lead).first(),
-                            is_deleted=is_deleted,
-                            phone=phone_value,
-                            email=email_value,
-                            amocrm_id=id_lead,
-                        )
-
-                        contacts_objects.append(amocrm_contact)
+        for id_lead, contact_id in lead_contacts.items():
+            response_data = contacts.get(contact_id)
+            if not response_data:
+                logger.warning(f"    ↳ Contact not found. Contact id: {contact_id}, Lead id {id_lead} - Ignored...")
+                continue
+            created_at_timestamp = int(response_data.get('created_at', 0) or 0)
+            updated_at_timestamp = int(response_data.get('updated_at', 0) or 0)
+            amocrm_contact = AmocrmContact(
+                date_created=datetime.datetime.fromtimestamp(created_at_timestamp, tz=moscow_timezone),
+                date_updated=datetime.datetime.fromtimestamp(updated_at_timestamp, tz=moscow_timezone),
+                name=response_data.get('name', ''),
+                responsible_user=users.get(response_data.get('responsible_user_id')),
+                is_deleted=response_data.get('is_deleted', ''),
+                phone=self.get_custom_field(response_data, 'PHONE'),
+                email=self.get_custom_field(response_data, 'EMAIL'),
+                amocrm_id=id_lead,
+            )
+            contacts_objects.append(amocrm_contact)
         logger.info("    ↳ New contacts objects: %(quantity)d" % {"quantity": len(contacts_objects)})
         with transaction.atomic():
             AmocrmContact.objects.bulk_create(contacts_objects, batch_size=1000)
@@ -10,7 +10,7 @@ from apps.choices import FunnelChannelUrlType
 from apps.traffic.models import FunnelChannelUrl
 
 from apps.sources.management.commands._base import BaseCommand
-from plugins.google.sheets import SheetsAPIClient
+from plugins.google.snapshot import SnapshotSheetsAPIClient
 
 logger = getLogger(__name__)
 
@@ -36,9 +36,10 @@ class Command(BaseCommand):
         return association.get(value) if association.get(value) else None
 
     def get_remote_url(self) -> list:
-        sheets_api = SheetsAPIClient()
-        worksheet = sheets_api.paid_urls.worksheet("Лендинги платный трафик и база")
-        values = worksheet.get_all_values()
+        sheets_api = SnapshotSheetsAPIClient()
+        values = sheets_api.get_values(
+            sheets_api.paid_urls, "Лендинги платный трафик и база"
+        )
         data = pandas.DataFrame(data=values[1:], columns=values[0])
         new_column_names = {
             'Посадочная': 'url_default',
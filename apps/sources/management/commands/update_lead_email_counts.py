@@ -0,0 +1,78 @@
+import datetime
+
+from typing import List, Iterator, Tuple
+from logging import getLogger
+
+from django.db.models import Max
+from django.utils import timezone
+
+from apps.sources.models import Lead
+from apps.traffic.models import LeadEmail, LeadEmailCount
+
+from ._base import BaseCommand
+
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 5000
+
+# Лиды, почта которых перепроверяется на каждом запуске
+WINDOW_DAYS = 30
+
+
+class Command(BaseCommand):
+    help = "Обновление количества лидов по почтам"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Полный пересчет по всем лидам",
+        )
+        parser.add_argument(
+            "--window",
+            required=False,
+            type=int,
+            default=WINDOW_DAYS,
+            help="Количество дней, за которые перепроверяются почты лидов",
+        )
+
+    def get_leads(self, **filters) -> Iterator[List[Tuple[int, str]]]:
+        queryset = (
+            Lead.objects.filter(**filters)
+            .order_by("pk")
+            .values_list("pk", "email")
+        )
+        chunk = []
+        for item in queryset.iterator(chunk_size=CHUNK_SIZE):
+            chunk.append(item)
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def handle(self, full: bool = False, window: int = WINDOW_DAYS, **kwargs):
+        logger.info("Update lead email counts")
+
+        # Первый запуск заполняет таблицы целиком
+        if full or not LeadEmail.objects.exists():
+            LeadEmail.objects.all().delete()
+            for chunk in self.get_leads():
+                LeadEmail.objects.sync(chunk)
+            quantity = LeadEmailCount.objects.rebuild()
+            logger.info("  ↳ Rebuilt: %(quantity)d" % {"quantity": quantity})
+            return
+
+        # Объединенные и удаленные лиды, новые лиды после последнего
+        # сохраненного и правки почты у лидов последних window дней
+        emails = LeadEmail.objects.purge()
+        from_id = LeadEmail.objects.aggregate(value=Max("lead_id")).get("value")
+        for chunk in self.get_leads(pk__gt=from_id or 0):
+            emails.update(LeadEmail.objects.sync(chunk))
+        since = timezone.now() - datetime.timedelta(days=window)
+        for chunk in self.get_leads(date_created__gte=since):
+            emails.update(LeadEmail.objects.sync(chunk))
+
+        logger.info("  ↳ Changed emails: %(quantity)d" % {"quantity": len(emails)})
+        LeadEmailCount.objects.refresh(emails)
@@ -9,7 +9,7 @@ from django.db import transaction
 from apps.traffic.models import LandingPage
 
 from apps.sources.management.commands._base import BaseCommand
-from plugins.google.sheets import SheetsAPIClient
+from plugins.google.snapshot import SnapshotSheetsAPIClient
 
 logger = getLogger(__name__)
 
@@ -23,9 +23,10 @@ class Command(BaseCommand):
         return url
 
     def get_remote_url(self) -> pandas.DataFrame:
-        sheets_api = SheetsAPIClient()
-        worksheet = sheets_api.paid_urls.worksheet("Лендинги платный трафик и база")
-        values = worksheet.get_all_values()
+        sheets_api = SnapshotSheetsAPIClient()
+        values = sheets_api.get_values(
+            sheets_api.paid_urls, "Лендинги платный трафик и база"
+        )
         data = pandas.DataFrame(data=values[1:], columns=values[0])
         return data
 
@@ -17,17 +17,26 @@ from django.utils import timezone
 from apps.sources.models import PaymentAnalytic, AmocrmContact, AmocrmUser, Lead
 
 from apps.sources.management.commands._base import BaseCommand
+from apps.sources.management.commands._metrics import MetricsMixin
+from apps.sources.management.commands.migrate_payment_analytic import (
+    PAYMENTS_COLUMNS,
+)
 from apps.traffic.models import LandingPage
 from apps.utils import queryset_as_dataframe
 from plugins.amocrm.api import AmocrmAPIClient
-from plugins.google.sheets import SheetsAPIClient
+from plugins.google.snapshot import SnapshotSheetsAPIClient
+from plugins.google.sync import SheetSync
 
 logger = getLogger(__name__)
 
+SNAPSHOT_FILENAME = "payments_copy_snapshot.json"
 
-class Command(BaseCommand):
+
+class Command(MetricsMixin, BaseCommand):
     help = "Обновление таблицы оплат"
 
+    remote_values: list[list[str]]
+
     def detect_amocrm_id(self, value: str) -> str:
         if not value:
             return ""
@@ -137,9 +146,13 @@ class Command(BaseCommand):
 
     def get_remote_table(self) -> pandas.DataFrame:
         logger.info("  ↳ Getting remote table")
-        sheets_api = SheetsAPIClient()
-        worksheet = sheets_api.payments_analytic.worksheet("Все оплаты")
-        values = worksheet.get_all_values()
+        sheets_api = SnapshotSheetsAPIClient()
+        spreadsheet = sheets_api.payments_analytic
+        with self.metrics.track(sheets_api.get_session(spreadsheet)):
+            values = sheets_api.get_appended_values(
+                spreadsheet, "Все оплаты", PAYMENTS_COLUMNS
+            )
+        self.remote_values = values
         data = pandas.DataFrame(data=values[1:], columns=values[0])
         data.index = range(2, 2 + len(data))
         new_column_names = {
@@ -214,10 +227,8 @@ class Command(BaseCommand):
     def update_remote_table(self, df: pandas.DataFrame):
         logger.info("  ↳ Updating remote table")
 
-        # ориг_remote
-        original_sheets_api = SheetsAPIClient()
-        original_worksheet = original_sheets_api.payments_analytic.worksheet("Все оплаты")
-        original_values = original_worksheet.get_all_values()
+        # ориг_remote, уже полученный в get_remote_table
+        original_values = self.remote_values
         original_data = pandas.DataFrame(data=original_values[1:], columns=original_values[0])
         original_data.index = range(2, 2 + len(original_data))
         original_data['Дата оплаты'] = pandas.to_datetime(original_data['Дата оплаты'], format='%d.%m.%Y').dt.strftime(
@@ -245,19 +256,31 @@ class Command(BaseCommand):
         merged_df['Дата оплаты'] = pandas.to_datetime(merged_df['Дата оплаты'], format='%Y-%m-%d').dt.strftime(
             '%d.%m.%Y')
 
-        # копия_remote
-        sheets_api = SheetsAPIClient()
-        worksheet = sheets_api.payments_copy.worksheet("Все оплаты")
-        worksheet.clear()
-        worksheet.update([merged_df.columns.values.tolist()] + merged_df.values.tolist())
+        # копия_remote, отправляем только измененные ячейки
+        merged_df = merged_df.fillna("")
+        sheets_api = SnapshotSheetsAPIClient()
+        spreadsheet = sheets_api.payments_copy
+        with self.metrics.track(sheets_api.get_session(spreadsheet)):
+            SheetSync(
+                spreadsheet.worksheet("Все оплаты"),
+                SNAPSHOT_FILENAME,
+                revision=lambda: sheets_api.get_revision(spreadsheet),
+            ).update(
+                [merged_df.columns.values.tolist()] + merged_df.values.tolist()
+            )
 
         logger.info("  ↳ Remote table was updated")
 
     def handle(self, **kwargs):
         logger.info("Update payment analytic start")
 
-        remote_table: pandas.DataFrame = self.get_remote_table()
-        updated_table: pandas.DataFrame = self.update_table(remote_table)
-        self.update_remote_table(updated_table)
+        with self.metrics.stage("load") as stage:
+            remote_table: pandas.DataFrame = self.get_remote_table()
+            stage["rows_out"] = len(remote_table)
+        with self.metrics.stage("update", rows_in=len(remote_table)) as stage:
+            updated_table: pandas.DataFrame = self.update_table(remote_table)
+            stage["rows_out"] = len(updated_table)
+        with self.metrics.stage("sync", rows_in=len(updated_table)):
+            self.update_remote_table(updated_table)
 
         logger.info("Update payment analytic finish")
@@ -0,0 +1,244 @@
+import math
+import datetime
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from apps.sources.models import AmocrmContact, SipuniCall
+from apps.sources.management.commands import update_amocrm_contacts
+from apps.sources.management.commands.migrate_sipuni_calls import (
+    Command as MigrateSipuniCallsCommand,
+)
+from plugins.google.sync import LocalWorksheet, SheetSync, diff_values
+
+
+SIPUNI_HEADER = (
+    "Тип;Статус;Время;Исходящая линия;Откуда;Куда;"
+    "Длительность звонка;Длительность разговора;Время ответа"
+)
+
+
+class SipuniHandler(BaseHTTPRequestHandler):
+    """
+    Локальная замена API выгрузки звонков Sipuni, отдает csv из server.csv
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = self.server.csv.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MigrateSipuniCallsTestCase(TestCase):
+    date = datetime.date(2024, 3, 1)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(("127.0.0.1", 0), SipuniHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def migrate(self, *rows: str) -> int:
+        self.server.csv = "\n".join([SIPUNI_HEADER, *rows]) + "\n"
+        with override_settings(
+            SIPUNI_API_URL=f"http://127.0.0.1:{self.server.server_port}/",
+            SIPUNI_API_USER="user",
+            SIPUNI_API_HASH="hash",
+        ):
+            command = MigrateSipuniCallsCommand()
+            command.session = command.get_session(1)
+            return command.process_day(self.date)
+
+    def test_upsert_by_normalized_phones(self):
+        self.migrate(
+            "Входящий;Отвечен;01.03.2024 10:00:00;1;89001234567;101;30;20;10",
+            "Входящий;Не отвечен;01.03.2024 11:00:00;1;+7 900 765-43-21;102;15;0;0",
+        )
+        self.assertEqual(SipuniCall.objects.count(), 2)
+
+        # Тот же звонок в другом формате номера обновляется, пропавший
+        # из выгрузки удаляется
+        quantity = self.migrate(
+            "Входящий;Отвечен;01.03.2024 10:00:00;1;+79001234567;101;40;30;10",
+        )
+        self.assertEqual(quantity, 1)
+        call = SipuniCall.objects.get()
+        self.assertEqual(call.time_call, 40)
+        self.assertEqual(call.dialing, 1)
+
+    def test_same_second_calls(self):
+        # Перезвон между теми же номерами в ту же секунду - отдельный звонок
+        rows = [
+            "Входящий;Не отвечен;01.03.2024 10:00:00;1;89001234567;101;5;0;0",
+            "Входящий;Не отвечен;01.03.2024 10:00:00;1;89001234567;101;5;0;0",
+            "Входящий;Отвечен;01.03.2024 10:00:00;1;89001234567;101;40;30;10",
+        ]
+        self.migrate(*rows)
+        self.assertEqual(SipuniCall.objects.count(), 3)
+
+        self.migrate(*rows)
+        self.assertEqual(SipuniCall.objects.count(), 3)
+
+
+class MemoryData:
+    """
+    plugins.data в памяти для SheetSync
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def dict(self, *args):
+        if len(args) == 2:
+            self.files[args[1]] = args[0]
+            return
+        if args[0] not in self.files:
+            raise FileNotFoundError(args[0])
+        return self.files[args[0]]
+
+
+class SheetSyncTestCase(SimpleTestCase):
+    def setUp(self):
+        data = MemoryData()
+        for name in ["data_reader", "data_writer"]:
+            patcher = mock.patch(f"plugins.google.sync.{name}", data)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_sync(self, worksheet: LocalWorksheet) -> SheetSync:
+        return SheetSync(
+            worksheet, "sync.json", revision=lambda: str(worksheet.revision)
+        )
+
+    def test_diff_values(self):
+        self.assertEqual(
+            diff_values(
+                [["a", "b", "c"], ["d"]],
+                [["a", "x", "y"], [], ["e"]],
+            ),
+            [
+                {"range": "B1:C1", "values": [["x", "y"]]},
+                {"range": "A2:A2", "values": [[""]]},
+                {"range": "A3:A3", "values": [["e"]]},
+            ],
+        )
+
+    def test_update(self):
+        worksheet = LocalWorksheet([["Почта", "Сумма"], ["a@a.ru", "100"]])
+        sync = self.get_sync(worksheet)
+
+        self.assertEqual(sync.update([["Почта", "Сумма"], ["a@a.ru", 150]]), 1)
+        self.assertEqual(
+            worksheet.requests[-1], [{"range": "B2:B2", "values": [[150]]}]
+        )
+        self.assertEqual(sync.update([["Почта", "Сумма"], ["a@a.ru", 150]]), 0)
+        self.assertEqual(len(worksheet.requests), 1)
+
+        # Ручная правка меняет ревизию листа и исправляется следующей записью
+        worksheet.values[1][0] = "manual@a.ru"
+        worksheet.revision += 1
+        self.assertEqual(sync.update([["Почта", "Сумма"], ["a@a.ru", 150]]), 1)
+        self.assertEqual(
+            worksheet.get_all_values(), [["Почта", "Сумма"], ["a@a.ru", "150"]]
+        )
+
+        # Правка в другом месте таблицы не вызывает перезапись чисел
+        worksheet.revision += 1
+        self.assertEqual(sync.update([["Почта", "Сумма"], ["a@a.ru", 150.0]]), 0)
+
+    def test_raw_values(self):
+        worksheet = LocalWorksheet()
+        sync = self.get_sync(worksheet)
+        values = [
+            ["Телефон", "Комментарий", "Сумма"],
+            ["0079001234567", "=1+1", 1.5],
+        ]
+
+        # RAW: строки не разбираются как формулы, ведущие нули сохраняются
+        sync.update(values)
+        self.assertEqual(
+            worksheet.get_all_values(value_render_option="UNFORMATTED_VALUE"),
+            values,
+        )
+
+
+class FakeAmocrm:
+    """
+    Замена plugins.amocrm.pagination.paginate: сделки с контактами и
+    контакты по filter[id], с подсчетом запросов
+    """
+
+    def __init__(self, quantity: int):
+        self.requests = 0
+        self.leads = dict(
+            (
+                lead_id,
+                {
+                    "id": lead_id,
+                    "_embedded": {
+                        "contacts": [{"id": lead_id + 100000, "is_main": True}]
+                    },
+                },
+            )
+            for lead_id in range(1, quantity + 1)
+        )
+        self.contacts = dict(
+            (
+                lead_id + 100000,
+                {
+                    "id": lead_id + 100000,
+                    "name": f"Контакт {lead_id}",
+                    "created_at": 1700000000,
+                    "updated_at": 1700000000,
+                    "responsible_user_id": 1,
+                    "is_deleted": False,
+                    "custom_fields_values": [
+                        {
+                            "field_code": "EMAIL",
+                            "values": [{"value": f"{lead_id}@a.ru"}],
+                        },
+                    ],
+                },
+            )
+            for lead_id in range(1, quantity + 1)
+        )
+
+    def paginate(self, method, entity, limit=250, filter=None, **params):
+        self.requests += 1
+        items = getattr(self, method)
+        yield [items[item] for item in filter["id"] if item in items]
+
+
+class UpdateAmocrmContactsTestCase(TestCase):
+    def test_batches(self):
+        quantity = 600
+        fake = FakeAmocrm(quantity)
+        command = update_amocrm_contacts.Command()
+        with mock.patch.object(update_amocrm_contacts, "paginate", fake.paginate):
+            command.update_amocrm_contact(
+                [str(item) for item in range(1, quantity + 1)] + ["", "abc"]
+            )
+
+        # Запросы пачками по CHUNK_SIZE вместо двух запросов на сделку
+        chunks = math.ceil(quantity / update_amocrm_contacts.CHUNK_SIZE)
+        self.assertEqual(fake.requests, 2 * chunks)
+        self.assertEqual(AmocrmContact.objects.count(), quantity)
+        self.assertEqual(
+            AmocrmContact.objects.get(amocrm_id=1).email, "1@a.ru"
+        )
@@ -40,3 +40,62 @@ class ChannelAdmin(admin.ModelAdmin):
         "key",
         "value",
     )
+
+
+@admin.register(models.ExpensesDaily)
+class ExpensesDailyAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "date",
+        "channel_name",
+        "landing_name",
+        "expenses",
+    )
+    search_fields = (
+        "channel_name",
+        "landing_name",
+    )
+    list_filter = ("date",)
+
+
+@admin.register(models.CallLeadMatch)
+class CallLeadMatchAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "call_id",
+        "source",
+        "lead_id",
+        "phone",
+        "date_call",
+        "date_lead",
+    )
+    search_fields = ("phone",)
+    list_filter = ("source", "date_call")
+
+
+@admin.register(models.LeadEmailCount)
+class LeadEmailCountAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "email",
+        "quantity",
+    )
+    search_fields = ("email",)
+
+
+@admin.register(models.LeadUploadJob)
+class LeadUploadJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "token",
+        "user_id",
+        "status",
+        "stage",
+        "progress",
+        "total",
+        "errors_count",
+        "created",
+        "updated",
+    )
+    search_fields = ("token",)
+    list_filter = ("status", "created")
@@ -0,0 +1,203 @@
+import uuid
+import logging
+import datetime
+import threading
+
+from typing import Callable, Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+
+from django.db import connection
+from django.utils import timezone
+
+from plugins.data import data_reader, data_writer
+
+from apps.traffic.models import LeadUploadJob
+
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILENAME = "upload_job_{token}_{name}.pkl"
+RESULT_NAMES = ["table", "detail"]
+
+# Интервал обновления heartbeat работающей задачи
+HEARTBEAT = datetime.timedelta(seconds=30)
+# Задача без heartbeat дольше этого времени считается прерванной
+STALE_AFTER = datetime.timedelta(minutes=5)
+# Время хранения состояния и результатов задачи
+EXPIRE_AFTER = datetime.timedelta(days=1)
+
+# Выполняемых задач на процесс web-сервера
+MAX_WORKERS = 2
+# Задач на процесс web-сервера, включая ожидающие в очереди пула
+MAX_QUEUED = 4
+# Активных задач во всех процессах web-сервера
+MAX_ACTIVE = 8
+
+# Локальный пул для фоновых задач, общий для процесса web-сервера. Очередь
+# пула не ограничена, поэтому принятые задачи ограничиваются семафором
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+queued = threading.BoundedSemaphore(MAX_QUEUED)
+
+
+class UploadJobsBusy(Exception):
+    pass
+
+
+class UploadJob:
+    """
+    Фоновая задача загрузки лидов.
+
+    Состояние (статус, прогресс, ошибки) хранится в LeadUploadJob, результаты
+    в plugins.data по токену задачи, поэтому доступны из любого процесса
+    web-сервера и не хранятся в сессии. Все изменения состояния выполняются
+    одним UPDATE без чтения, поэтому блокировки между процессами не нужны.
+
+    Работающая задача обновляет heartbeat (LeadUploadJob.updated), задача без
+    heartbeat дольше STALE_AFTER (процесс перезапущен) помечается ошибкой.
+    Задачи старше EXPIRE_AFTER очищаются при создании новых.
+
+    Новая задача отклоняется с UploadJobsBusy, если в процессе уже принято
+    MAX_QUEUED задач или во всех процессах активно MAX_ACTIVE задач.
+    """
+
+    def __init__(self, token: str):
+        self.token = token
+
+    def is_valid(self) -> bool:
+        try:
+            return uuid.UUID(self.token, version=4).hex == self.token
+        except (TypeError, ValueError, AttributeError):
+            return False
+
+    @classmethod
+    def submit(
+        cls, user_id: int, func: Callable[..., None], *args, **kwargs
+    ) -> "UploadJob":
+        cls.cleanup()
+        if not queued.acquire(blocking=False):
+            raise UploadJobsBusy("Upload jobs queue of the process is full")
+        try:
+            LeadUploadJob.objects.interrupt_stale(STALE_AFTER)
+            if LeadUploadJob.objects.active().count() >= MAX_ACTIVE:
+                raise UploadJobsBusy("Too many active upload jobs")
+            job = cls(uuid.uuid4().hex)
+            now = timezone.now()
+            LeadUploadJob.objects.create(
+                token=job.token, user_id=user_id, created=now, updated=now
+            )
+            executor.submit(job.run, func, *args, **kwargs)
+        except BaseException:
+            queued.release()
+            raise
+        return job
+
+    @classmethod
+    def cleanup(cls):
+        """
+        Очистка задач старше EXPIRE_AFTER: результаты заменяются пустыми,
+        состояние удаляется
+        """
+        tokens = LeadUploadJob.objects.expire(EXPIRE_AFTER)
+        for token in tokens:
+            job = cls(token)
+            for name in RESULT_NAMES:
+                job.set_result(name, pandas.DataFrame({}))
+        if tokens:
+            logger.info(f"Upload jobs expired: {len(tokens)}")
+
+    def heartbeat(self, stopped: threading.Event):
+        try:
+            while not stopped.wait(HEARTBEAT.total_seconds()):
+                LeadUploadJob.objects.active().filter(token=self.token).update(
+                    updated=timezone.now()
+                )
+        finally:
+            connection.close()
+
+    def run(self, func: Callable[..., None], *args, **kwargs):
+        stopped = threading.Event()
+        try:
+            self.update(status="running")
+            threading.Thread(
+                target=self.heartbeat, args=(stopped,), daemon=True
+            ).start()
+            func(self, *args, **kwargs)
+            self.update(status="done")
+        except Exception as error:
+            logger.exception(f"Upload job {self.token} failed")
+            self.update(status="error", error=str(error))
+        finally:
+            stopped.set()
+            queued.release()
+            connection.close()
+
+    def get_state(self) -> Dict[str, Any]:
+        if not self.is_valid():
+            return {}
+        LeadUploadJob.objects.interrupt_stale(STALE_AFTER, token=self.token)
+        state = (
+            LeadUploadJob.objects.filter(token=self.token)
+            .values(
+                "status",
+                "user_id",
+                "stage",
+                "progress",
+                "total",
+                "errors",
+                "errors_count",
+                "error",
+                "created",
+                "updated",
+            )
+            .first()
+        )
+        if state is None:
+            return {}
+        state["user"] = state.pop("user_id")
+        return state
+
+    def update(self, **values):
+        LeadUploadJob.objects.filter(token=self.token).update(
+            updated=timezone.now(), **values
+        )
+
+    def progress(self, done: int, total: int):
+        self.update(progress=done, total=total)
+
+    def set_result(self, name: str, dataframe: pandas.DataFrame):
+        data_writer.dataframe(
+            dataframe, RESULT_FILENAME.format(token=self.token, name=name)
+        )
+
+    def get_result(self, name: str) -> pandas.DataFrame:
+        if not self.is_valid():
+            return pandas.DataFrame({})
+        try:
+            return data_reader.dataframe(
+                RESULT_FILENAME.format(token=self.token, name=name)
+            )
+        except FileNotFoundError:
+            return pandas.DataFrame({})
+
+    def get_page(
+        self, name: str, page: int = 1, per_page: int = 100
+    ) -> Dict[str, Any]:
+        dataframe = self.get_result(name)
+        page = max(page, 1)
+        start = (page - 1) * per_page
+        records: List[Dict[str, Any]] = (
+            dataframe.iloc[start : start + per_page]
+            .astype(str)
+            .to_dict("records")
+        )
+        return {
+            "page": page,
+            "per_page": per_page,
+            "total": len(dataframe),
+            "results": records,
+        }
+
+    def is_owner(self, user_id: Optional[int]) -> bool:
+        return user_id is not None and self.get_state().get("user") == user_id
@@ -1,4 +1,11 @@
+import datetime
+
+from typing import Iterable, List, Set, Tuple
+
+from django.db import transaction
+from django.db.models import Sum, Count, Subquery, QuerySet
 from django.db.models.manager import Manager
+from django.utils import timezone
 
 
 class FunnelChannelUrlManager(Manager):
@@ -11,3 +18,174 @@ class LandingPageManager(Manager):
 
 class ChannelManager(Manager):
     pass
+
+
+class ExpensesDailyManager(Manager):
+    def refresh(self, dates: Iterable[datetime.date]) -> int:
+        """
+        Пересчет расходов за дни dates из RoistatAnalytic
+        """
+        from apps.sources.models import RoistatAnalytic
+
+        dates = list(dates)
+        if not dates:
+            return 0
+        rows = (
+            RoistatAnalytic.objects.filter(date__in=dates)
+            .values(
+                "date",
+                "dimension_marker_level_1_id",
+                "dimension_marker_level_1__name",
+                "dimension_landing_page_id",
+                "dimension_landing_page__name",
+            )
+            .annotate(total=Sum("expenses"))
+            .order_by()
+        )
+        instances = [
+            self.model(
+                date=row["date"],
+                channel=row["dimension_marker_level_1_id"],
+                channel_name=row["dimension_marker_level_1__name"],
+                landing=row["dimension_landing_page_id"],
+                landing_name=row["dimension_landing_page__name"],
+                expenses=row["total"] or 0,
+            )
+            for row in rows
+        ]
+        with transaction.atomic():
+            self.filter(date__in=dates).delete()
+            self.bulk_create(instances, batch_size=1000)
+        return len(instances)
+
+
+class PhoneIndexManager(Manager):
+    pass
+
+
+class CallLeadMatchManager(Manager):
+    pass
+
+
+class LeadEmailManager(Manager):
+    def sync(self, leads: Iterable[Tuple[int, str]]) -> Set[str]:
+        """
+        Обновление почт лидов leads (id, почта), возвращает затронутые
+        почты: прежние и новые. Почта нормализуется только здесь
+        (normalize_email), лиды без почты не хранятся
+        """
+        from apps.traffic.utils import normalize_email
+
+        actual = dict(
+            (lead_id, normalize_email(email)) for lead_id, email in leads
+        )
+        stored = dict(
+            self.filter(lead_id__in=actual.keys()).values_list("lead_id", "email")
+        )
+        changed = [
+            lead_id
+            for lead_id, email in actual.items()
+            if stored.get(lead_id, "") != email
+        ]
+        if not changed:
+            return set()
+        with transaction.atomic():
+            self.filter(lead_id__in=changed).delete()
+            self.bulk_create(
+                [
+                    self.model(lead_id=lead_id, email=actual.get(lead_id))
+                    for lead_id in changed
+                    if actual.get(lead_id)
+                ],
+                batch_size=1000,
+            )
+        return set(
+            filter(
+                None,
+                [actual.get(lead_id) for lead_id in changed]
+                + [stored.get(lead_id) for lead_id in changed],
+            )
+        )
+
+    def purge(self) -> Set[str]:
+        """
+        Удаление лидов, которых больше нет (объединены или удалены),
+        возвращает их почты
+        """
+        from apps.sources.models import Lead
+
+        removed = self.exclude(lead_id__in=Subquery(Lead.objects.values("pk")))
+        emails = set(removed.values_list("email", flat=True))
+        if emails:
+            removed.delete()
+        return emails
+
+
+class LeadEmailCountManager(Manager):
+    CHUNK_SIZE = 1000
+
+    def get_counts(self, emails: Iterable[str] = None) -> QuerySet:
+        from apps.traffic.models import LeadEmail
+
+        queryset = LeadEmail.objects.all()
+        if emails is not None:
+            queryset = queryset.filter(email__in=emails)
+        return queryset.values("email").annotate(quantity=Count("pk")).order_by()
+
+    def refresh(self, emails: Iterable[str]) -> int:
+        """
+        Пересчет количества лидов для почт emails по LeadEmail
+        """
+        emails = sorted(set(filter(None, emails)))
+        quantity = 0
+        for index in range(0, len(emails), self.CHUNK_SIZE):
+            chunk = emails[index : index + self.CHUNK_SIZE]
+            instances = [
+                self.model(email=row["email"], quantity=row["quantity"])
+                for row in self.get_counts(chunk)
+            ]
+            with transaction.atomic():
+                self.filter(email__in=chunk).delete()
+                self.bulk_create(instances, batch_size=1000)
+            quantity += len(instances)
+        return quantity
+
+    def rebuild(self) -> int:
+        """
+        Полный пересчет по LeadEmail
+        """
+        instances = [
+            self.model(email=row["email"], quantity=row["quantity"])
+            for row in self.get_counts().iterator()
+        ]
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(instances, batch_size=1000)
+        return len(instances)
+
+
+class LeadUploadJobManager(Manager):
+    ACTIVE = ("pending", "running")
+
+    def active(self) -> QuerySet:
+        return self.filter(status__in=self.ACTIVE)
+
+    def interrupt_stale(self, stale_after: datetime.timedelta, **filters) -> int:
+        """
+        Задачи без heartbeat дольше stale_after помечаются прерванными.
+        Обновление условное, поэтому живая задача, успевшая обновить
+        heartbeat, не затрагивается
+        """
+        return self.active().filter(
+            updated__lt=timezone.now() - stale_after, **filters
+        ).update(status="error", error="Задача прервана", updated=timezone.now())
+
+    def expire(self, expire_after: datetime.timedelta) -> List[str]:
+        """
+        Удаление задач старше expire_after, возвращает их токены
+        """
+        expired = self.filter(created__lt=timezone.now() - expire_after)
+        tokens = list(expired.values_list("token", flat=True))
+        if tokens:
+            self.filter(token__in=tokens).delete()
+        return tokens
@@ -0,0 +1,68 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("traffic", "0003_alter_channel_key"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ExpensesDaily",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True, verbose_name="Дата")),
+                (
+                    "channel",
+                    models.BigIntegerField(
+                        blank=True, null=True, verbose_name="Канал (marker_level_1)"
+                    ),
+                ),
+                (
+                    "channel_name",
+                    models.CharField(
+                        blank=True,
+                        max_length=2048,
+                        null=True,
+                        verbose_name="Название канала",
+                    ),
+                ),
+                (
+                    "landing",
+                    models.BigIntegerField(
+                        blank=True, null=True, verbose_name="Посадочная страница"
+                    ),
+                ),
+                (
+                    "landing_name",
+                    models.CharField(
+                        blank=True,
+                        max_length=2048,
+                        null=True,
+                        verbose_name="Название посадочной страницы",
+                    ),
+                ),
+                ("expenses", models.FloatField(default=0, verbose_name="Расход")),
+            ],
+            options={
+                "verbose_name": "Расход за день",
+                "verbose_name_plural": "Расходы по дням",
+                "db_table": "traffic_expenses_daily",
+                "ordering": ("-date",),
+                "indexes": [
+                    models.Index(
+                        fields=["date", "channel"],
+                        name="traffic_exp_daily_date_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 4.2.5 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("traffic", "0004_expensesdaily"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PhoneIndex",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phone",
+                    models.CharField(max_length=16, verbose_name="Телефон (E.164)"),
+                ),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("call", "Звонок Sipuni"),
+                            ("lead", "Лид"),
+                            ("tildalead", "Tilda лид"),
+                            ("contact", "Контакт AmoCRM"),
+                        ],
+                        max_length=16,
+                        verbose_name="Источник",
+                    ),
+                ),
+                ("object_id", models.BigIntegerField(verbose_name="ID записи")),
+                (
+                    "date",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Дата"),
+                ),
+            ],
+            options={
+                "verbose_name": "Телефон",
+                "verbose_name_plural": "Индекс телефонов",
+                "db_table": "traffic_phone_index",
+                "ordering": ("-date",),
+                "unique_together": {("source", "object_id", "phone")},
+                "indexes": [
+                    models.Index(
+                        fields=["phone", "source", "date"],
+                        name="traffic_phone_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="CallLeadMatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("call_id", models.BigIntegerField(verbose_name="ID звонка")),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("lead", "Лид"),
+                            ("tildalead", "Tilda лид"),
+                            ("contact", "Контакт AmoCRM"),
+                        ],
+                        default="lead",
+                        max_length=16,
+                        verbose_name="Источник",
+                    ),
+                ),
+                (
+                    "lead_id",
+                    models.BigIntegerField(db_index=True, verbose_name="ID записи"),
+                ),
+                (
+                    "phone",
+                    models.CharField(max_length=16, verbose_name="Телефон (E.164)"),
+                ),
+                ("date_call", models.DateTimeField(verbose_name="Дата звонка")),
+                ("date_lead", models.DateTimeField(verbose_name="Дата лида")),
+            ],
+            options={
+                "verbose_name": "Звонок лида",
+                "verbose_name_plural": "Звонки лидов",
+                "db_table": "traffic_call_lead_match",
+                "ordering": ("-date_call",),
+                "unique_together": {("call_id", "source")},
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("traffic", "0005_phoneindex_callleadmatch"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LeadEmail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "lead_id",
+                    models.BigIntegerField(unique=True, verbose_name="ID лида"),
+                ),
+                (
+                    "email",
+                    models.TextField(
+                        db_index=True, verbose_name="Почта (нормализованная)"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Почта лида",
+                "verbose_name_plural": "Почты лидов",
+                "db_table": "traffic_lead_email",
+                "ordering": ("lead_id",),
+            },
+        ),
+        migrations.CreateModel(
+            name="LeadEmailCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "email",
+                    models.TextField(
+                        unique=True, verbose_name="Почта (нормализованная)"
+                    ),
+                ),
+                (
+                    "quantity",
+                    models.PositiveIntegerField(verbose_name="Количество лидов"),
+                ),
+            ],
+            options={
+                "verbose_name": "Количество лидов по почте",
+                "verbose_name_plural": "Количество лидов по почтам",
+                "db_table": "traffic_lead_email_count",
+                "ordering": ("email",),
+            },
+        ),
+    ]
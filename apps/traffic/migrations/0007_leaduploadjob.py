@@ -0,0 +1,81 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("traffic", "0006_leademailcount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LeadUploadJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "token",
+                    models.CharField(max_length=32, unique=True, verbose_name="Токен"),
+                ),
+                (
+                    "user_id",
+                    models.IntegerField(null=True, verbose_name="Пользователь"),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "В очереди"),
+                            ("running", "Выполняется"),
+                            ("done", "Завершена"),
+                            ("error", "Ошибка"),
+                            ("expired", "Удалена"),
+                        ],
+                        default="pending",
+                        max_length=16,
+                        verbose_name="Статус",
+                    ),
+                ),
+                (
+                    "stage",
+                    models.CharField(blank=True, max_length=32, verbose_name="Этап"),
+                ),
+                (
+                    "progress",
+                    models.PositiveIntegerField(default=0, verbose_name="Обработано"),
+                ),
+                (
+                    "total",
+                    models.PositiveIntegerField(default=0, verbose_name="Всего"),
+                ),
+                ("errors", models.JSONField(default=list, verbose_name="Ошибки")),
+                (
+                    "errors_count",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Количество ошибок"
+                    ),
+                ),
+                ("error", models.TextField(blank=True, verbose_name="Ошибка задачи")),
+                (
+                    "created",
+                    models.DateTimeField(db_index=True, verbose_name="Создана"),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(db_index=True, verbose_name="Heartbeat"),
+                ),
+            ],
+            options={
+                "verbose_name": "Загрузка лидов",
+                "verbose_name_plural": "Загрузки лидов",
+                "db_table": "traffic_lead_upload_job",
+                "ordering": ("-created",),
+            },
+        ),
+    ]
@@ -57,3 +57,171 @@ class Channel(models.Model):
 
     def __str__(self):
         return f"[{self.key}] {self.value}"
+
+
+class ExpensesDaily(models.Model):
+    date = models.DateField(verbose_name="Дата", db_index=True)
+    channel = models.BigIntegerField(
+        verbose_name="Канал (marker_level_1)", null=True, blank=True
+    )
+    channel_name = models.CharField(
+        verbose_name="Название канала", max_length=2048, null=True, blank=True
+    )
+    landing = models.BigIntegerField(
+        verbose_name="Посадочная страница", null=True, blank=True
+    )
+    landing_name = models.CharField(
+        verbose_name="Название посадочной страницы",
+        max_length=2048,
+        null=True,
+        blank=True,
+    )
+    expenses = models.FloatField(verbose_name="Расход", default=0)
+
+    objects = managers.ExpensesDailyManager()
+
+    class Meta:
+        verbose_name = "Расход за день"
+        verbose_name_plural = "Расходы по дням"
+        db_table = "traffic_expenses_daily"
+        ordering = ("-date",)
+        indexes = [
+            models.Index(
+                fields=["date", "channel"], name="traffic_exp_daily_date_idx"
+            )
+        ]
+
+    def __str__(self):
+        return f"[{self.date}] {self.channel_name}: {self.expenses}"
+
+
+class PhoneIndex(models.Model):
+    SOURCES = (
+        ("call", "Звонок Sipuni"),
+        ("lead", "Лид"),
+        ("tildalead", "Tilda лид"),
+        ("contact", "Контакт AmoCRM"),
+    )
+
+    phone = models.CharField(verbose_name="Телефон (E.164)", max_length=16)
+    source = models.CharField(
+        verbose_name="Источник", max_length=16, choices=SOURCES
+    )
+    object_id = models.BigIntegerField(verbose_name="ID записи")
+    date = models.DateTimeField(verbose_name="Дата", null=True, blank=True)
+
+    objects = managers.PhoneIndexManager()
+
+    class Meta:
+        verbose_name = "Телефон"
+        verbose_name_plural = "Индекс телефонов"
+        db_table = "traffic_phone_index"
+        ordering = ("-date",)
+        unique_together = ("source", "object_id", "phone")
+        indexes = [
+            models.Index(
+                fields=["phone", "source", "date"],
+                name="traffic_phone_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"[{self.source}] {self.phone}"
+
+
+class CallLeadMatch(models.Model):
+    SOURCES = (
+        ("lead", "Лид"),
+        ("tildalead", "Tilda лид"),
+        ("contact", "Контакт AmoCRM"),
+    )
+
+    call_id = models.BigIntegerField(verbose_name="ID звонка")
+    source = models.CharField(
+        verbose_name="Источник", max_length=16, choices=SOURCES, default="lead"
+    )
+    lead_id = models.BigIntegerField(verbose_name="ID записи", db_index=True)
+    phone = models.CharField(verbose_name="Телефон (E.164)", max_length=16)
+    date_call = models.DateTimeField(verbose_name="Дата звонка")
+    date_lead = models.DateTimeField(verbose_name="Дата лида")
+
+    objects = managers.CallLeadMatchManager()
+
+    class Meta:
+        verbose_name = "Звонок лида"
+        verbose_name_plural = "Звонки лидов"
+        db_table = "traffic_call_lead_match"
+        ordering = ("-date_call",)
+        unique_together = ("call_id", "source")
+
+    def __str__(self):
+        return f"{self.call_id} -> [{self.source}] {self.lead_id}"
+
+
+class LeadEmail(models.Model):
+    lead_id = models.BigIntegerField(verbose_name="ID лида", unique=True)
+    email = models.TextField(verbose_name="Почта (нормализованная)", db_index=True)
+
+    objects = managers.LeadEmailManager()
+
+    class Meta:
+        verbose_name = "Почта лида"
+        verbose_name_plural = "Почты лидов"
+        db_table = "traffic_lead_email"
+        ordering = ("lead_id",)
+
+    def __str__(self):
+        return f"{self.lead_id}: {self.email}"
+
+
+class LeadEmailCount(models.Model):
+    email = models.TextField(verbose_name="Почта (нормализованная)", unique=True)
+    quantity = models.PositiveIntegerField(verbose_name="Количество лидов")
+
+    objects = managers.LeadEmailCountManager()
+
+    class Meta:
+        verbose_name = "Количество лидов по почте"
+        verbose_name_plural = "Количество лидов по почтам"
+        db_table = "traffic_lead_email_count"
+        ordering = ("email",)
+
+    def __str__(self):
+        return f"{self.email}: {self.quantity}"
+
+
+class LeadUploadJob(models.Model):
+    STATUSES = (
+        ("pending", "В очереди"),
+        ("running", "Выполняется"),
+        ("done", "Завершена"),
+        ("error", "Ошибка"),
+        ("expired", "Удалена"),
+    )
+
+    token = models.CharField(verbose_name="Токен", max_length=32, unique=True)
+    user_id = models.IntegerField(verbose_name="Пользователь", null=True)
+    status = models.CharField(
+        verbose_name="Статус", max_length=16, choices=STATUSES, default="pending"
+    )
+    stage = models.CharField(verbose_name="Этап", max_length=32, blank=True)
+    progress = models.PositiveIntegerField(verbose_name="Обработано", default=0)
+    total = models.PositiveIntegerField(verbose_name="Всего", default=0)
+    errors = models.JSONField(verbose_name="Ошибки", default=list)
+    errors_count = models.PositiveIntegerField(
+        verbose_name="Количество ошибок", default=0
+    )
+    error = models.TextField(verbose_name="Ошибка задачи", blank=True)
+    created = models.DateTimeField(verbose_name="Создана", db_index=True)
+    updated = models.DateTimeField(verbose_name="Heartbeat", db_index=True)
+
+    objects = managers.LeadUploadJobManager()
+
+    class Meta:
+        verbose_name = "Загрузка лидов"
+        verbose_name_plural = "Загрузки лидов"
+        db_table = "traffic_lead_upload_job"
+        ordering = ("-created",)
+
+    def __str__(self):
+        return f"{self.token}: {self.status}"
@@ -8,6 +8,7 @@ app_name = "traffic"
 urlpatterns = [
     path("leads/", views.LeadsView.as_view(), name="leads"),
     path("leads/upload/", views.UploadLeadsView.as_view(), name="upload_leads"),
+    path("leads/upload/job/", views.UploadLeadsJobView.as_view(), name="upload_leads_job"),
     path("ipl/", views.IPLReportView.as_view(), name="ipl"),
     path("channels/", views.ChannelsView.as_view(), name="channels"),
     path("funnels/", views.FunnelsView.as_view(), name="funnels"),
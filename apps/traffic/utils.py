@@ -1,4 +1,6 @@
 import html
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from datetime import date, datetime, time, timedelta
 from typing import Optional
 from urllib.parse import parse_qsl, urlparse
@@ -6,6 +8,7 @@ from urllib.parse import parse_qsl, urlparse
 import pandas
 import pytz
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
 from apps.api.v1.tilda.views import AVAILABLE_FIELDS_NAME as AVAILABLE_FIELDS_NAME_BASE
@@ -23,6 +26,25 @@ AVAILABLE_FIELDS_NAME = AVAILABLE_FIELDS_NAME_BASE.copy()
 AVAILABLE_FIELDS_NAME.update({"date_created": ["date_created"]})
 
 
+def normalize_phone(value: str) -> str:
+    """
+    Телефон в формате E.164, российские номера приводятся к +7,
+    пустая строка для значений, не похожих на номер
+    """
+    digits = "".join(filter(str.isdigit, str(value or "")))
+    if len(digits) == 11 and digits[0] == "8":
+        digits = "7" + digits[1:]
+    elif len(digits) == 10 and digits[0] == "9":
+        digits = "7" + digits
+    if not 11 <= len(digits) <= 15:
+        return ""
+    return f"+{digits}"
+
+
+def normalize_email(value: str) -> str:
+    return str(value or "").strip().lower()
+
+
 def translate_channel(value: str, channels: dict) -> str:
     return channels[value] if value in channels else value
 
@@ -102,6 +124,110 @@ class LeadAPIView(TildaLeadAPIView):
     available_fields_name = AVAILABLE_FIELDS_NAME
 
 
+class TildaLeadBatchCreator:
+    """
+    Пакетное добавление tilda лидов.
+
+    Строки chunk_size сначала разбираются и проверяются по одной, ошибка
+    любой строки (в том числе разбора) попадает в список ошибок и не
+    прерывает загрузку. Затем корректные строки chunk добавляются одной
+    транзакцией через LeadAPIView (валидация, история, карусель), ошибка
+    строки откатывает только ее точку сохранения.
+
+    Каждая строка по-прежнему проходит через LeadAPIView: пакет сокращает
+    только число транзакций, но не число запросов к базе на строку.
+    """
+
+    def __init__(self, chunk_size: int = 500):
+        self.chunk_size = chunk_size
+        self.view = LeadAPIView()
+
+    @staticmethod
+    def get_error(index, data: pandas.Series, error) -> dict:
+        return {
+            "index": index,
+            "email": data.get("email", ""),
+            "phone": data.get("phone", ""),
+            "error": str(error),
+        }
+
+    def prepare(self, data: pandas.Series) -> HttpRequest:
+        request = HttpRequest(data=TildaLeadsParseData(data=data)())
+        request.method = "POST"
+        return request
+
+    def create_one(self, request: HttpRequest) -> Optional[str]:
+        try:
+            with transaction.atomic():
+                response = self.view.post(request)
+        except Exception as error:
+            return str(error)
+        status_code = getattr(response, "status_code", 200)
+        if status_code >= 400:
+            return str(getattr(response, "data", status_code))
+
+    def create_chunk(self, chunk: pandas.DataFrame) -> list[dict]:
+        errors = []
+        requests = []
+        for index, data in chunk.iterrows():
+            try:
+                requests.append((index, data, self.prepare(data)))
+            except Exception as error:
+                errors.append(self.get_error(index, data, error))
+        with transaction.atomic():
+            for index, data, request in requests:
+                error = self.create_one(request)
+                if error is not None:
+                    errors.append(self.get_error(index, data, error))
+        return errors
+
+    def __call__(self, dataframe: pandas.DataFrame, progress=None) -> list[dict]:
+        errors = []
+        for start in range(0, len(dataframe), self.chunk_size):
+            if progress is not None:
+                progress(start, len(dataframe))
+            errors += self.create_chunk(dataframe.iloc[start : start + self.chunk_size])
+        return errors
+
+
+class TildaLeadIndex:
+    """
+    Tilda лиды, сгруппированные по (почта, цифры телефона), внутри группы
+    отсортированные по дате создания
+    """
+
+    def __init__(self, dataframe: pandas.DataFrame):
+        buckets = defaultdict(list)
+        if not dataframe.empty:
+            dates = pandas.to_datetime(dataframe["date_created"], utc=True)
+            for date_created, lead in zip(dates, dataframe.itertuples(index=False)):
+                buckets[self.get_key(lead.email, lead.phone)].append((date_created, lead))
+        self.dates = {}
+        self.leads = {}
+        for key, items in buckets.items():
+            items.sort(key=lambda item: item[0])
+            self.dates[key] = [item[0] for item in items]
+            self.leads[key] = [item[1] for item in items]
+
+    @staticmethod
+    def get_key(email: str, phone: str) -> tuple[str, str]:
+        return email, "".join(filter(str.isdigit, str(phone or "")))
+
+    def get(self, email: str, phone: str, created: str, hours: int = 16) -> list:
+        """
+        Лиды с той же почтой и телефоном, созданные в пределах +/- hours
+        """
+        key = self.get_key(email, phone)
+        dates = self.dates.get(key)
+        if not dates:
+            return []
+        date = pandas.to_datetime(created, utc=True)
+        if pandas.isna(date):
+            return []
+        delta = pandas.to_timedelta(hours, unit="h")
+        return self.leads[key][bisect_left(dates, date - delta) : bisect_right(dates, date + delta)]
+
+
 def detect_pay_url_category(value: str, landings: list) -> str:
     association = {
         "intensive3day": "type_intensiv3",
@@ -207,11 +333,14 @@ def get_regs_for_cr(date_of_events: pandas.DataFrame, landings: list) -> Optiona
         group_leads = leads_df[date_from_mask & date_to_mask].copy()
         group_leads = group_leads[group_leads["category"] == course]
         group_leads["date_event"] = item_date
-        group_leads["is_duplicated"] = group_leads["email"].duplicated(keep=False)
 
         result = pandas.concat([result, group_leads], ignore_index=True)
 
     if not result.empty:
+        # Дубли почты внутри выборки одного мероприятия (дата, курс)
+        result["is_duplicated"] = result.duplicated(
+            subset=["date_event", "category", "email"], keep=False
+        )
         result.drop(columns=["roistat_url", "url", "date_created"], inplace=True)
         return result
 
@@ -8,14 +8,16 @@ import requests
 
 from typing import List, Dict, Any
 
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef, QuerySet, Subquery
 from xlsxwriter import Workbook
-from collections import Counter, defaultdict
+from collections import defaultdict
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs
 
 from django.conf import settings
 from django.urls import reverse_lazy
-from django.http import HttpResponseRedirect, FileResponse
+from django.views import View
+from django.http import HttpResponseRedirect, FileResponse, JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
 
 from apps.utils import queryset_as_dataframe
@@ -37,7 +39,14 @@ from apps.datatable.renderer import Renderer
 
 from plugins.data import data_reader
 
-from .models import LandingPage, Channel, FunnelChannelUrl
+from .jobs import UploadJob, UploadJobsBusy
+from .models import (
+    LandingPage,
+    Channel,
+    FunnelChannelUrl,
+    LeadEmail,
+    LeadEmailCount,
+)
 
 from .tables import (
     LeadsTable,
@@ -65,15 +74,13 @@ from .utils import (
     detect_channel_from_params,
     parse_url,
     detect_pay_traffic,
-    TildaLeadsParseData,
-    HttpRequest,
-    LeadAPIView,
+    TildaLeadIndex,
+    TildaLeadBatchCreator,
     get_event,
     get_members_for_cr,
     get_regs_for_cr,
     get_subscriptions_for_cr,
 )
-from ..api.exceptions import APIException
 
 ANALYTIC_TZ = pytz.timezone(settings.ANALYTIC_TIME_ZONE)
 logger = logging.getLogger("django")
@@ -829,7 +836,22 @@ class DoubleView(LPRequiredMixin, DatatableDataframeView):
                     date_created__date__gte=lead_df,
                     date_created__date__lte=lead_dt,
                 )
-                return Lead.objects.filter(set_filter).values("date_created", "email", "roistat_url")
+                return self.annotate_double(Lead.objects.filter(set_filter)).values(
+                    "date_created", "email", "roistat_url", "count_double"
+                )
+
+    def annotate_double(self, queryset: QuerySet) -> QuerySet:
+        """
+        Признак дубля по счетчику лидов нормализованной почты
+        """
+        email = LeadEmail.objects.filter(lead_id=OuterRef("pk")).values("email")
+        return queryset.annotate(email_normalized=Subquery(email[:1])).annotate(
+            count_double=Exists(
+                LeadEmailCount.objects.filter(
+                    email=OuterRef("email_normalized"), quantity__gt=1
+                )
+            )
+        )
 
     def prepare_table(self, data: pandas.DataFrame) -> pandas.DataFrame:
         landings = list(
@@ -840,8 +862,6 @@ class DoubleView(LPRequiredMixin, DatatableDataframeView):
         channels = {item["key"]: item["value"] for item in channel_data}
         queryset = self.update_filters()
         if queryset:
-            db_email_list = list(Lead.objects.values_list("email", flat=True))
-            email_counter = Counter(db_email_list)
             df = pandas.DataFrame.from_records(queryset)
             df["params"] = df["roistat_url"].apply(parse_url_params)
             df["params"] = df["params"].apply(detect_empty_params)
@@ -854,9 +874,7 @@ class DoubleView(LPRequiredMixin, DatatableDataframeView):
             df = df.dropna(subset=["channel", "url", "email"])
             df["url"] = df["url"].apply(detect_pay_traffic, args=(landings,))
             df = df[df["url"]]
-            df["count_double"] = df["email"].apply(
-                lambda x: 1 if email_counter[x] > 1 else 0
-            )
+            df["count_double"] = df["count_double"].astype(int)
             df["channel"] = df["channel"].apply(
                 translate_channel, args=(channels,)
             )
@@ -941,13 +959,12 @@ class DoubleView(LPRequiredMixin, DatatableDataframeView):
         lead_dt = request.GET.get("lead_dt")
 
         if lead_df and lead_dt:
-            queryset = Lead.objects.filter(
-                date_created__date__gte=lead_df,
-                date_created__date__lte=lead_dt,
-            ).values("date_created", "name", "phone", "email", "roistat_url")
-
-            db_email_list = list(Lead.objects.values_list("email", flat=True))
-            email_counter = Counter(db_email_list)
+            queryset = self.annotate_double(
+                Lead.objects.filter(
+                    date_created__date__gte=lead_df,
+                    date_created__date__lte=lead_dt,
+                )
+            ).values("date_created", "name", "phone", "email", "roistat_url", "count_double")
 
             df = pandas.DataFrame.from_records(queryset)
 
@@ -964,9 +981,7 @@ class DoubleView(LPRequiredMixin, DatatableDataframeView):
             df = df.dropna(subset=["channel", "url", "email", "event"])
             df["url"] = df["url"].apply(detect_pay_traffic, args=(landings,))
             df = df[df["url"]]
-            df["count_double"] = df["email"].apply(
-                lambda x: 1 if email_counter[x] > 1 else 0
-            )
+            df["count_double"] = df["count_double"].astype(int)
             df["channel"] = df["channel"].apply(
                 translate_channel, args=(channels,)
             )
@@ -1059,27 +1074,32 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
     filterset_class = UploadFilter
     table_pagination = False
 
+    def get_job(self) -> UploadJob | None:
+        token = self.request.session.get("upload_job")
+        if token is None:
+            return
+        job = UploadJob(token)
+        if not job.is_owner(self.request.user.pk):
+            return
+        return job
+
     def get_data(self):
-        if "table" in self.request.session:
-            table_data = self.request.session["table"]
-            return pandas.DataFrame(table_data)
+        job = self.get_job()
+        if job is not None:
+            return job.get_result("table")
         return pandas.DataFrame({})
 
     @staticmethod
-    def create_tildaleads(dataframe: pandas.DataFrame) -> None:
+    def create_tildaleads(dataframe: pandas.DataFrame, progress=None) -> list[dict]:
         """
         Метод добавляет в БД тильда лиды, создает историю и добавляет в
-        карусельку
+        карусельку, возвращает ошибки по строкам
         """
-        for _, data in dataframe.iterrows():
-            try:
-                lead_data = TildaLeadsParseData(data=data)()
-                request = HttpRequest(data=lead_data)
-                request.method = "POST"
-                tildaLeads_view = LeadAPIView()
-                tildaLeads_view.post(request)
-            except APIException as err:
-                logger.info(f"ERROR: {data.email}, {data.phone} | {err}")
+        errors = TildaLeadBatchCreator()(dataframe, progress=progress)
+        for error in errors:
+            logger.info(f"ERROR: {error['email']}, {error['phone']} | {error['error']}")
+        logger.info(f"Tilda leads uploaded: {len(dataframe) - len(errors)}, errors: {len(errors)}")
+        return errors
 
     @staticmethod
     def read_file(request) -> pandas.DataFrame | None:
@@ -1109,6 +1129,7 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
         }
 
     @staticmethod
+    @lru_cache(maxsize=100000)
     def parse_roistat_url(url) -> dict[str, str]:
         parsed_url = urlparse(url)
         qs = parse_qs(parsed_url.query)
@@ -1163,37 +1184,6 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
             return True
         return False
 
-    @staticmethod
-    def get_numbers_from_phone(phone: str):
-        return "".join(filter(str.isdigit, phone))
-
-    def get_leads_by(
-            self, tildaleds: pandas.DataFrame, **kwargs
-    ) -> pandas.DataFrame:
-        condition = None
-        for key, value in kwargs.items():
-            if condition is None:
-                condition = tildaleds[key] == value
-            else:
-                if key == "phone":
-                    condition &= tildaleds[key].apply(
-                        self.get_numbers_from_phone
-                    ) == self.get_numbers_from_phone(value)
-                elif key == "created":
-                    # отбираются лиды с +\- 16 часов
-                    date = pandas.to_datetime(value, utc=True)
-                    hours_delta = pandas.to_timedelta(16, unit="h")
-                    condition &= (
-                                         tildaleds["date_created"] >= date - hours_delta
-                                 ) & (tildaleds["date_created"] <= date + hours_delta)
-                else:
-                    condition &= tildaleds[key] == value
-
-        if condition is None:
-            return tildaleds
-
-        return tildaleds[condition]
-
     def check_one_lead(self, row_data: tuple, lead: pandas.Series) -> bool:
         roistat_url = str(row_data.roistat_url)
         if roistat_url.startswith("http") and lead.roistat_url.startswith(
@@ -1213,68 +1203,47 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
             csv_dataframe: pandas.DataFrame,
             tildaleads_dataframe: pandas.DataFrame,
             log: bool = False,
+            progress=None,
     ) -> pandas.DataFrame:
         logger.info("Getting undefined leads to upload into database...")
+        tildaleads_index = TildaLeadIndex(tildaleads_dataframe)
         undefined_leads = list()
-        for row_data in csv_dataframe.itertuples(index=False):
+        for number, row_data in enumerate(csv_dataframe.itertuples(index=False)):
+            if progress is not None and number % 1000 == 0:
+                progress(number, len(csv_dataframe))
             # phone + email
-            leads_by_email_phone = self.get_leads_by(
-                tildaleds=tildaleads_dataframe,
+            leads = tildaleads_index.get(
                 email=row_data.email,
                 phone=row_data.phone,
                 created=row_data.created,
             )
 
-            if leads_by_email_phone.empty or leads_by_email_phone.shape[0] == 1:
-                lead = (
-                    leads_by_email_phone.iloc[0]
-                    if not leads_by_email_phone.empty
-                    else None
-                )
+            if len(leads) <= 1:
+                lead = leads[0] if leads else None
                 if lead is None or self.check_one_lead(row_data, lead):
-                    # logger.info(f'{row_data.name}, {row_data.email} NOT exists')
                     undefined_leads.append(row_data)
                     continue
 
             # phone + email + roistat url
             roistat_url = str(row_data.roistat_url)
-            leads_by_roistat = (
-                leads_by_email_phone[
-                    leads_by_email_phone.roistat_url.str.startswith(
-                        self.parse_roistat_url(roistat_url)["url"]
-                    )
-                ]
-                if roistat_url.startswith("http")
-                else leads_by_email_phone[
-                    leads_by_email_phone.roistat_url.str.startswith(roistat_url)
-                ]
-            )
+            if roistat_url.startswith("http"):
+                roistat_url = self.parse_roistat_url(roistat_url)["url"]
+            leads = [
+                lead for lead in leads if str(lead.roistat_url).startswith(roistat_url)
+            ]
 
-            if leads_by_roistat.empty or leads_by_roistat.shape[0] == 1:
-                lead = (
-                    leads_by_roistat.iloc[0]
-                    if not leads_by_roistat.empty
-                    else None
-                )
+            if len(leads) <= 1:
+                lead = leads[0] if leads else None
                 if lead is None or self.check_one_lead(row_data, lead):
-                    # logger.info(f'{row_data.name}, {row_data.email} NOT exists')
                     undefined_leads.append(row_data)
                     continue
 
             # phone + email + roistat url + qa
-            leads_by_qa = leads_by_roistat[
-                (leads_by_roistat.qa_1 == row_data.qa_1)
-                & (leads_by_roistat.qa_2 == row_data.qa_2)
-                & (leads_by_roistat.qa_3 == row_data.qa_3)
-                & (leads_by_roistat.qa_4 == row_data.qa_4)
-                & (leads_by_roistat.qa_5 == row_data.qa_5)
-                & (leads_by_roistat.qa_6 == row_data.qa_6)
-                ]
-
-            if leads_by_qa.empty or leads_by_qa.shape[0] == 1:
-                lead = leads_by_qa.iloc[0] if not leads_by_qa.empty else None
+            leads = [lead for lead in leads if not self.check_qa(row_data, lead)]
+
+            if len(leads) <= 1:
+                lead = leads[0] if leads else None
                 if lead is None or self.check_one_lead(row_data, lead):
-                    # logger.info(f'{row_data.name}, {row_data.email} NOT exists')
                     undefined_leads.append(row_data)
                     continue
 
@@ -1305,9 +1274,35 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
             df[column] = df[column].astype(str).str.strip()
         return df
 
+    def process_upload(self, job: UploadJob, dataframe: pandas.DataFrame, mode: str):
+        """
+        Поиск новых лидов и, в режиме upload, их добавление; выполняется в
+        фоновой задаче
+        """
+        job.update(stage="matching")
+        total = len(dataframe)
+        tildaleads_df = self.get_tildaleads(days=28)
+        dataframe = self.get_undefined_leads(
+            csv_dataframe=dataframe,
+            tildaleads_dataframe=tildaleads_df,
+            progress=job.progress,
+        )
+        job.progress(total, total)
+        landing_pages = set(
+            self.get_landing_page(url)
+            for url in dataframe["roistat_url"]
+            if len(str(url)) > 0 and str(url).startswith("http")
+        )
+        job.set_result("detail", dataframe)
+        job.set_result("table", pandas.DataFrame(data=landing_pages, columns=["roistat_url"]))
+
+        if mode == "upload":
+            job.update(stage="upload", progress=0, total=len(dataframe))
+            errors = self.create_tildaleads(dataframe, progress=job.progress)
+            job.update(errors=errors[:100], errors_count=len(errors), progress=len(dataframe))
+
     def post(self, request, *args, **kwargs):
         dataframe = self.read_file(request)
-        tildaleads_df = self.get_tildaleads(days=28)
         mode = request.POST.get("mode")
 
         if not dataframe.empty:
@@ -1316,44 +1311,54 @@ class UploadLeadsView(LPRequiredMixin, DatatableDataframeView):
             dataframe = dataframe[self.get_columns().keys()]
             dataframe = self.normalize_df(dataframe)
             dataframe.rename(columns=self.get_columns(), inplace=True)
-            dataframe = self.get_undefined_leads(
-                csv_dataframe=dataframe, tildaleads_dataframe=tildaleads_df
-            )
-            landing_pages = set(
-                self.get_landing_page(url)
-                for url in dataframe["roistat_url"]
-                if len(str(url)) > 0 and str(url).startswith("http")
-            )
-            table_data = pandas.DataFrame(
-                data=landing_pages, columns=["roistat_url"]
-            )
-            self.table_data = table_data
-            context = self.get_context_data(**kwargs)
-            context["table_detail"] = self.table_detail_class(
-                dataframe, request=request
-            )
-            context["filter"] = self.filterset_class(request=self.request)
-            self.request.session["table_detail"] = dataframe.to_dict("records")
-            self.request.session["table"] = table_data.to_dict("records")
-
-            if mode == "upload":
-                self.create_tildaleads(dataframe)
-
-            return self.render_to_response(context)
+            try:
+                job = UploadJob.submit(request.user.pk, self.process_upload, dataframe, mode)
+            except UploadJobsBusy:
+                return JsonResponse({"error": "Busy"}, status=503)
+            self.request.session["upload_job"] = job.token
+            self.request.session.pop("table", None)
+            self.request.session.pop("table_detail", None)
 
         return HttpResponseRedirect(reverse_lazy("traffic:upload_leads"))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        if "table_detail" in self.request.session:
-            table_detail = self.table_detail_class(
-                pandas.DataFrame(self.request.session["table_detail"]),
-                request=self.request,
-            )
-            context.update({"table_detail": table_detail})
+        job = self.get_job()
+        if job is not None:
+            state = job.get_state()
+            context.update({"upload_job": dict(state, token=job.token)})
+            if state.get("status") == "done":
+                table_detail = self.table_detail_class(
+                    job.get_result("detail"),
+                    request=self.request,
+                )
+                context.update({"table_detail": table_detail})
         return context
 
 
+class UploadLeadsJobView(LPRequiredMixin, View):
+    permission_required = ("core.page_view_traffic_upload_leads",)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Состояние задачи загрузки и, при наличии page, страница результата
+        """
+        job = UploadJob(request.GET.get("token") or request.session.get("upload_job", ""))
+        if not job.is_owner(request.user.pk):
+            return JsonResponse({"error": "NotFound"}, status=404)
+        data = {"token": job.token, **job.get_state()}
+        if "page" in request.GET:
+            try:
+                page = int(request.GET.get("page"))
+                per_page = int(request.GET.get("per_page", 100))
+            except ValueError:
+                return JsonResponse({"error": "InvalidPage"}, status=400)
+            if page < 1 or not 1 <= per_page <= 1000:
+                return JsonResponse({"error": "InvalidPage"}, status=400)
+            data.update(job.get_page("detail", page=page, per_page=per_page))
+        return JsonResponse(data)
+
+
 class TelegramView(LPRequiredMixin, DatatableDataframeView):
     template_name = "traffic/telegram/index.html"
     page_title = "CR в Telegram"
@@ -1405,18 +1410,20 @@ class TelegramView(LPRequiredMixin, DatatableDataframeView):
 
         if regs is not None and subscriptions is not None:
             # join members
-            regs["count_member"] = (
-                regs.apply(
-                    lambda row: row["email"] in members[(members["course"] == row["category"]) &
-                                                        (members["date"] == row["date_event"])]["email"].tolist()
-                    , axis=1
-                )
+            member_keys = (
+                members[["email", "course", "date"]]
+                .rename(columns={"course": "category", "date": "date_event"})
+                .drop_duplicates()
+                .assign(count_member=1)
             )
+            regs = regs.merge(member_keys, on=["email", "category", "date_event"], how="left")
+            regs["count_member"] = regs["count_member"].fillna(0).astype(int)
 
             # join subs
             merge_on_columns = ['email', 'channel', 'date_event', 'category']
-            regs_with_subs = regs.merge(subscriptions, on=merge_on_columns, how='left', indicator=True)
-            regs['tg_visit'] = regs_with_subs['_merge'].apply(lambda x: 1 if x == 'both' else 0)
+            subscription_keys = subscriptions[merge_on_columns].drop_duplicates().assign(tg_visit=1)
+            regs = regs.merge(subscription_keys, on=merge_on_columns, how="left")
+            regs["tg_visit"] = regs["tg_visit"].fillna(0).astype(int)
 
             # rename channels
             channels = dict(Channel.objects.values_list("key", "value"))
@@ -0,0 +1,65 @@
+from typing import List, Dict, Any, Iterator
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.amocrm.api import AmocrmAPIClient
+from plugins.amocrm.transport import transport
+
+
+logger = getLogger(__name__)
+
+
+def get_page(
+    method: str, entity: str, page: int, **params
+) -> List[Dict[str, Any]]:
+    logger.info(
+        "  ↳ Request API %(method)s page: %(page)d"
+        % {"method": method, "page": page}
+    )
+    # Клиент работает через общую сессию transport: пул, limiter и повторы
+    client = AmocrmAPIClient(session=transport.session)
+    response = getattr(client, method).get(page=page, **params) or {}
+    return response.get("_embedded", {}).get(entity, [])
+
+
+def paginate(
+    method: str,
+    entity: str,
+    limit: int = 250,
+    prefetch: int = 2,
+    **params,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Постраничное получение сущностей списочного метода amoCRM.
+
+    Отдает страницы по мере получения, следующие prefetch страниц
+    запрашиваются заранее. Получение прекращается на первой неполной
+    странице.
+    """
+    page = 1
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        futures = [
+            executor.submit(
+                get_page, method, entity, page + index, limit=limit, **params
+            )
+            for index in range(max(prefetch, 1))
+        ]
+        while futures:
+            items = futures.pop(0).result()
+            if items:
+                yield items
+            if len(items) < limit:
+                for future in futures:
+                    future.cancel()
+                break
+            futures.append(
+                executor.submit(
+                    get_page,
+                    method,
+                    entity,
+                    page + len(futures) + 1,
+                    limit=limit,
+                    **params,
+                )
+            )
+            page += 1
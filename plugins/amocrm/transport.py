@@ -0,0 +1,170 @@
+import time
+import random
+import asyncio
+
+from typing import List, Dict, Any, Optional, Iterable
+from logging import getLogger
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from plugins.ratelimit import TokenBucket
+
+
+logger = getLogger(__name__)
+
+# https://www.amocrm.ru/developers/content/api/recommendations
+# не более 7 запросов в секунду с одной интеграции
+AMOCRM_RATE = 7
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Методы, которые безопасно отправить повторно
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+limiter = TokenBucket(AMOCRM_RATE)
+
+
+class AmocrmAdapter(HTTPAdapter):
+    """
+    Адаптер сессии для amoCRM: пул соединений, общий limiter и повторы.
+
+    Повторяются только идемпотентные запросы (GET/HEAD/OPTIONS) и запросы
+    с заголовком Idempotency-Key: ответы 429/5xx и ошибки соединения
+    повторяются с экспоненциальной задержкой и случайным разбросом,
+    заголовок Retry-After учитывается. Запись без ключа отправляется
+    один раз, чтобы таймаут после применения на сервере не продублировал ее.
+    """
+
+    def __init__(
+        self,
+        retries: int = 5,
+        backoff: float = 0.5,
+        backoff_max: float = 30,
+        **kwargs,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        super().__init__(**kwargs)
+
+    def get_delay(
+        self, attempt: int, response: Optional[requests.Response] = None
+    ) -> float:
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2**attempt)
+        )
+
+    def is_retryable(self, request: requests.PreparedRequest) -> bool:
+        return (
+            request.method in IDEMPOTENT_METHODS
+            or IDEMPOTENCY_HEADER in request.headers
+        )
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs
+    ) -> requests.Response:
+        retries = self.retries if self.is_retryable(request) else 0
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == retries:
+                    raise
+                delay = self.get_delay(attempt)
+                logger.warning(
+                    "    ↳ %(error)s, retry in %(delay).1fs"
+                    % {"error": error.__class__.__name__, "delay": delay}
+                )
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+                delay = self.get_delay(attempt, response)
+                logger.warning(
+                    "    ↳ Status %(status)d, retry in %(delay).1fs"
+                    % {"status": response.status_code, "delay": delay}
+                )
+                response.close()
+            time.sleep(delay)
+
+
+class Transport:
+    """
+    Общая HTTP-сессия для запросов к amoCRM.
+
+    Сессия с AmocrmAdapter передается клиенту AmocrmAPIClient(session=...),
+    поэтому соединения переиспользуются (keep-alive, пул на pool_size
+    соединений), а limiter и повторы применяются ко всем методам клиента.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 16,
+        retries: int = 5,
+        backoff: float = 0.5,
+        backoff_max: float = 30,
+        timeout: float = 30,
+    ):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = AmocrmAdapter(
+            retries=retries,
+            backoff=backoff,
+            backoff_max=backoff_max,
+            pool_connections=4,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool_size = pool_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # Пул потоков нужен только для arequest/gather
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        return self._executor
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    async def arequest(
+        self, method: str, url: str, **kwargs
+    ) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.request, method, url, **kwargs)
+        )
+
+    async def gather(
+        self, items: Iterable[Dict[str, Any]], concurrency: int = AMOCRM_RATE
+    ) -> List[requests.Response]:
+        """
+        Параллельное выполнение запросов, items - аргументы request
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(item: Dict[str, Any]) -> requests.Response:
+            async with semaphore:
+                return await self.arequest(**item)
+
+        return await asyncio.gather(*[run(item) for item in items])
+
+
+transport = Transport()
@@ -0,0 +1,205 @@
+import json
+import hashlib
+import datetime
+
+from typing import List, Dict, Optional
+from logging import getLogger
+
+import requests
+
+from gspread import Spreadsheet
+
+from plugins.data import data_reader, data_writer
+from plugins.google.sheets import SheetsAPIClient
+from plugins.google.sync import column_letter
+
+
+logger = getLogger(__name__)
+
+Values = List[List[str]]
+
+
+class SnapshotSheetsAPIClient(SheetsAPIClient):
+    """
+    Клиент с локальным кэшем значений листов.
+
+    Значения хранятся в plugins.data с ключом spreadsheet/worksheet и
+    временем последнего изменения файла, поэтому несколько команд одного
+    запуска DAG скачивают неизмененный лист только один раз.
+    """
+
+    memory: Dict[str, Dict[str, Values]] = {}
+
+    def get_revision(self, spreadsheet: Spreadsheet) -> Optional[str]:
+        try:
+            if hasattr(spreadsheet, "get_lastUpdateTime"):
+                return str(spreadsheet.get_lastUpdateTime())
+            return str(spreadsheet.lastUpdateTime)
+        except Exception as error:
+            logger.warning(
+                "    ↳ Spreadsheet revision unavailable: %(error)s"
+                % {"error": error}
+            )
+
+    def get_session(self, spreadsheet: Spreadsheet) -> requests.Session:
+        """
+        HTTP-сессия клиента gspread (для подсчета запросов)
+        """
+        client = spreadsheet.client
+        return getattr(client, "http_client", client).session
+
+    def get_filename(self, spreadsheet: Spreadsheet, title: str) -> str:
+        key = hashlib.md5(f"{spreadsheet.id}:{title}".encode()).hexdigest()
+        return f"sheets_snapshot_{key}.json"
+
+    def load_snapshot(self, filename: str) -> Optional[Dict[str, Values]]:
+        cached = self.memory.get(filename)
+        if cached is None:
+            try:
+                cached = data_reader.dict(filename)
+            except FileNotFoundError:
+                return
+            self.memory[filename] = cached
+        return cached
+
+    def read_snapshot(self, filename: str, revision: str) -> Optional[Values]:
+        cached = self.load_snapshot(filename)
+        if cached is None or cached.get("revision") != revision:
+            return
+        return cached.get("values")
+
+    def write_snapshot(
+        self,
+        filename: str,
+        revision: str,
+        values: Values,
+        full_read_at: Optional[str] = None,
+    ):
+        snapshot = {
+            "revision": revision,
+            "values": values,
+            "full_read_at": full_read_at
+            or datetime.datetime.utcnow().isoformat(),
+        }
+        self.memory[filename] = snapshot
+        data_writer.dict(snapshot, filename)
+
+    def get_values(self, spreadsheet: Spreadsheet, title: str) -> Values:
+        """
+        Значения листа title, из кэша если файл не изменялся
+        """
+        revision = self.get_revision(spreadsheet)
+        filename = self.get_filename(spreadsheet, title)
+        if revision is not None:
+            values = self.read_snapshot(filename, revision)
+            if values is not None:
+                logger.info(
+                    "    ↳ Worksheet from snapshot: %(title)s" % {"title": title}
+                )
+                return values
+
+        values = spreadsheet.worksheet(title).get_all_values()
+        if revision is not None:
+            self.write_snapshot(filename, revision, values)
+        return values
+
+    def get_checksum(self, values: Values) -> str:
+        return hashlib.md5(
+            json.dumps(values, ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def pad_rows(self, values: Values, width: int) -> Values:
+        return [(row + [""] * width)[:width] for row in values]
+
+    def read_tail(
+        self, worksheet, cached: Values, window: int, columns: List[str]
+    ) -> Optional[Values]:
+        """
+        Дочитывание строк, добавленных в конец листа после cached.
+
+        Тем же запросом перечитываются заголовок и последние window строк
+        cached, их контрольная сумма сверяется со снимком: вставка или
+        удаление строк выше сдвигает окно и меняет сумму. Правки внутри
+        старых строк подхватывает периодическое полное чтение. При
+        расхождении или отсутствии колонки columns в заголовке
+        возвращается None.
+        """
+        if len(cached) <= window:
+            return
+        names = [name.strip().lower() for name in cached[0]]
+        for name in columns:
+            if name.strip().lower() not in names:
+                logger.info("    ↳ Column not found: %(name)s" % {"name": name})
+                return
+
+        width = max(len(row) for row in cached)
+        start = len(cached) - window + 1
+        header, tail = worksheet.batch_get(
+            ["1:1", f"A{start}:{column_letter(width)}"]
+        )
+        header = self.pad_rows(list(header), width)
+        tail = self.pad_rows(list(tail), width)
+        if self.get_checksum(header + tail[:window]) != self.get_checksum(
+            cached[:1] + cached[-window:]
+        ):
+            logger.info("    ↳ Worksheet changed above watermark")
+            return
+        logger.info(
+            "    ↳ Appended rows: %(quantity)d" % {"quantity": len(tail) - window}
+        )
+        return cached + tail[window:]
+
+    def is_expired(
+        self, cached: Dict[str, Values], refresh: datetime.timedelta
+    ) -> bool:
+        full_read_at = cached.get("full_read_at")
+        if not full_read_at:
+            return True
+        return (
+            datetime.datetime.fromisoformat(full_read_at) + refresh
+            < datetime.datetime.utcnow()
+        )
+
+    def get_appended_values(
+        self,
+        spreadsheet: Spreadsheet,
+        title: str,
+        columns: Optional[List[str]] = None,
+        window: int = 50,
+        refresh: datetime.timedelta = datetime.timedelta(days=1),
+    ) -> Values:
+        """
+        Значения листа, который пополняется добавлением строк в конец.
+
+        Из API читаются только новые строки после сохраненного снимка и
+        окно последних window строк для проверки, колонки columns
+        (используемые командами) должны быть в заголовке. Полное чтение
+        выполняется при первом запуске, без columns, при любом расхождении
+        и не реже одного раза за refresh, чтобы подхватить правки в
+        старых строках.
+        """
+        revision = self.get_revision(spreadsheet)
+        filename = self.get_filename(spreadsheet, title)
+        cached = self.load_snapshot(filename)
+        if cached is not None and revision is not None:
+            if cached.get("revision") == revision:
+                return cached.get("values")
+
+        worksheet = spreadsheet.worksheet(title)
+        if (
+            columns
+            and cached is not None
+            and not self.is_expired(cached, refresh)
+        ):
+            values = self.read_tail(
+                worksheet, cached.get("values"), window, columns
+            )
+            if values is not None:
+                self.write_snapshot(
+                    filename, revision, values, cached.get("full_read_at")
+                )
+                return values
+
+        values = worksheet.get_all_values()
+        self.write_snapshot(filename, revision, values)
+        return values
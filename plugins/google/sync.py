@@ -0,0 +1,265 @@
+import math
+import datetime
+
+from typing import List, Dict, Any, Optional, Tuple, Callable
+from logging import getLogger
+
+from plugins.data import data_reader, data_writer
+
+
+logger = getLogger(__name__)
+
+Values = List[List[str]]
+
+
+def column_letter(index: int) -> str:
+    """
+    Буквенное обозначение колонки по ее номеру (начиная с 1)
+    """
+    letters = ""
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def column_index(letters: str) -> int:
+    """
+    Номер колонки (начиная с 1) по ее буквенному обозначению
+    """
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - 64
+    return index
+
+
+def cell_a1(row: int, col: int) -> str:
+    return f"{column_letter(col)}{row}"
+
+
+def parse_a1(value: str) -> Tuple[int, int]:
+    letters = "".join(filter(str.isalpha, value))
+    digits = "".join(filter(str.isdigit, value))
+    return int(digits), column_index(letters)
+
+
+def native_value(cell: Any) -> Any:
+    """
+    Значение ячейки для записи RAW: числа и строки без изменений,
+    пропуски - пустая строка, даты - строка в формате ISO
+    """
+    if cell is None or (isinstance(cell, float) and math.isnan(cell)):
+        return ""
+    if isinstance(cell, (datetime.date, datetime.datetime)):
+        return cell.isoformat()
+    if isinstance(cell, (bool, int, float, str)):
+        return cell
+    return str(cell)
+
+
+def cell_text(cell: Any) -> str:
+    """
+    Строковое представление для сравнения записанного значения и значения,
+    прочитанного с UNFORMATTED_VALUE (целые числа API отдает без .0)
+    """
+    if cell is None:
+        return ""
+    if isinstance(cell, float) and cell.is_integer():
+        return str(int(cell))
+    return str(cell)
+
+
+def normalize_values(values: List[List[Any]]) -> Values:
+    return [[cell_text(cell) for cell in row] for row in values]
+
+
+def diff_values(
+    old: Values, new: Values, send: Optional[List[List[Any]]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Список диапазонов, отличающихся между old и new.
+
+    Каждая строка разбивается на непрерывные отрезки измененных ячеек,
+    ячейки, отсутствующие в new, затираются пустой строкой. Сравниваются
+    строковые значения, в диапазоны попадают значения send той же формы
+    (по умолчанию new).
+    """
+    send = new if send is None else send
+    ranges = []
+    for row_index in range(max(len(old), len(new))):
+        old_row = old[row_index] if row_index < len(old) else []
+        new_row = new[row_index] if row_index < len(new) else []
+        send_row = send[row_index] if row_index < len(send) else []
+        width = max(len(old_row), len(new_row))
+        start = None
+        for col_index in range(width + 1):
+            if col_index < width:
+                old_cell = old_row[col_index] if col_index < len(old_row) else ""
+                new_cell = new_row[col_index] if col_index < len(new_row) else ""
+                changed = old_cell != new_cell
+            else:
+                changed = False
+            if changed and start is None:
+                start = col_index
+            elif not changed and start is not None:
+                values = [
+                    send_row[index] if index < len(send_row) else ""
+                    for index in range(start, col_index)
+                ]
+                ranges.append(
+                    {
+                        "range": f"{cell_a1(row_index + 1, start + 1)}:"
+                        f"{cell_a1(row_index + 1, col_index)}",
+                        "values": [values],
+                    }
+                )
+                start = None
+    return ranges
+
+
+class LocalWorksheet:
+    """
+    Локальная замена gspread.Worksheet для проверки синхронизации без API
+    """
+
+    def __init__(self, values: Optional[List[List[Any]]] = None):
+        self.values = [list(row) for row in values or []]
+        self.row_count = max(len(self.values), 1)
+        self.col_count = max([len(row) for row in self.values] + [1])
+        self.requests: List[List[Dict[str, Any]]] = []
+        self.revision = 0
+
+    def get_all_values(
+        self, value_render_option: str = "FORMATTED_VALUE"
+    ) -> List[List[Any]]:
+        if value_render_option == "UNFORMATTED_VALUE":
+            return [list(row) for row in self.values]
+        return [[str(cell) for cell in row] for row in self.values]
+
+    def resize(self, rows: Optional[int] = None, cols: Optional[int] = None):
+        if rows is not None:
+            self.row_count = rows
+        if cols is not None:
+            self.col_count = cols
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs):
+        self.requests.append(data)
+        self.revision += 1
+        for item in data:
+            start, _ = item["range"].split(":")
+            row, col = parse_a1(start)
+            for row_offset, values in enumerate(item["values"]):
+                row_index = row - 1 + row_offset
+                if row_index >= self.row_count:
+                    raise ValueError(f"Range {item['range']} exceeds grid limits")
+                while len(self.values) <= row_index:
+                    self.values.append([])
+                target = self.values[row_index]
+                for col_offset, value in enumerate(values):
+                    col_index = col - 1 + col_offset
+                    if col_index >= self.col_count:
+                        raise ValueError(
+                            f"Range {item['range']} exceeds grid limits"
+                        )
+                    while len(target) <= col_index:
+                        target.append("")
+                    target[col_index] = "" if value is None else value
+        # Google Sheets не возвращает пустые хвосты строк и таблицы
+        for row in self.values:
+            while row and row[-1] == "":
+                row.pop()
+        while self.values and not self.values[-1]:
+            self.values.pop()
+
+
+class SheetSync:
+    """
+    Запись таблицы в worksheet только измененными ячейками.
+
+    Последнее записанное состояние и ревизия листа хранятся в plugins.data
+    под именем snapshot_name. Ревизия читается до сравнения: снимок
+    используется, только если она не изменилась с последней записи, иначе
+    (ручные правки, нет revision) текущие значения читаются из worksheet,
+    и правки перезаписываются. После записи сначала читается ревизия, затем
+    значения листа, поэтому правка, сделанная сразу после записи, попадает
+    либо в снимок, либо в следующую ревизию.
+
+    Значения записываются RAW в исходных типах: числа остаются числами,
+    строки не разбираются как формулы, телефоны и ведущие нули не меняются.
+    Лист читается с UNFORMATTED_VALUE, и обе стороны сравниваются через
+    cell_text.
+    """
+
+    def __init__(
+        self,
+        worksheet,
+        snapshot_name: str,
+        batch_size: int = 500,
+        value_input_option: str = "RAW",
+        revision: Optional[Callable[[], Optional[str]]] = None,
+    ):
+        self.worksheet = worksheet
+        self.snapshot_name = snapshot_name
+        self.batch_size = batch_size
+        self.value_input_option = value_input_option
+        self.revision = revision
+
+    def get_revision(self) -> Optional[str]:
+        if self.revision is None:
+            return
+        return self.revision()
+
+    def read_values(self) -> Values:
+        return normalize_values(
+            self.worksheet.get_all_values(value_render_option="UNFORMATTED_VALUE")
+        )
+
+    def get_snapshot(self, revision: Optional[str]) -> Values:
+        try:
+            snapshot = data_reader.dict(self.snapshot_name)
+        except FileNotFoundError:
+            snapshot = {}
+        if revision is None or snapshot.get("revision") != revision:
+            logger.info("    ↳ Worksheet changed since snapshot, reading worksheet")
+            return self.read_values()
+        return snapshot.get("values", [])
+
+    def save_snapshot(self, values: Values, revision: Optional[str]):
+        data_writer.dict(
+            {"values": values, "revision": revision}, self.snapshot_name
+        )
+
+    def resize(self, values: Values):
+        rows = len(values)
+        cols = max([len(row) for row in values] + [0])
+        if rows > self.worksheet.row_count or cols > self.worksheet.col_count:
+            self.worksheet.resize(
+                rows=max(rows, self.worksheet.row_count),
+                cols=max(cols, self.worksheet.col_count),
+            )
+
+    def update(self, values: List[List[Any]]) -> int:
+        """
+        Отправка изменений, возвращает количество измененных диапазонов
+        """
+        send = [[native_value(cell) for cell in row] for row in values]
+        values = normalize_values(send)
+        revision = self.get_revision()
+        ranges = diff_values(self.get_snapshot(revision), values, send)
+        logger.info(
+            "    ↳ Changed ranges: %(quantity)d" % {"quantity": len(ranges)}
+        )
+        if ranges:
+            self.resize(values)
+            for index in range(0, len(ranges), self.batch_size):
+                self.worksheet.batch_update(
+                    ranges[index : index + self.batch_size],
+                    value_input_option=self.value_input_option,
+                )
+            # Ревизия после записи включает и ручные правки, сделанные до
+            # ее чтения, поэтому снимок - значения листа после ревизии
+            revision = self.get_revision()
+            if revision is not None:
+                values = self.read_values()
+        self.save_snapshot(values, revision)
+        return len(ranges)
@@ -0,0 +1,25 @@
+import pytz
+import datetime
+
+from airflow import DAG
+
+from scheduler.operators import amocrm_events as operators
+
+
+dag = DAG(
+    dag_id="AmocrmEvents",
+    description="Обновление сделок AmoCRM по ленте событий",
+    schedule_interval="*/10 * * * *",
+    catchup=False,
+    max_active_runs=1,
+    start_date=datetime.datetime.combine(
+        datetime.datetime.now().astimezone(pytz.UTC).date(), datetime.time.min
+    ),
+)
+
+
+migrate_amocrm_events_op = operators.Operator(
+    task_id="MigrateAmocrmEvents",
+    pool=operators.AMOCRM_LEADS_POOL,
+    dag=dag,
+)
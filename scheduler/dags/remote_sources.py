@@ -4,6 +4,7 @@ import datetime
 from airflow import DAG
 
 from scheduler.operators import remote_sources as operators
+from scheduler.operators.amocrm_events import AMOCRM_LEADS_POOL
 
 dag = DAG(
     dag_id="RemoteSources",
@@ -21,6 +22,7 @@ migrate_roistat_leads_op = operators.MigrateRoistatLeadsOperator(
 )
 migrate_amocrm_leads_op = operators.MigrateAmocrmLeadsOperator(
     task_id="MigrateAmocrmLeads",
+    pool=AMOCRM_LEADS_POOL,
     dag=dag,
 )
 merge_tilda_leads_op = operators.MergeTildaLeadsOperator(
@@ -55,10 +57,14 @@ intensives_emails_op = operators.IntensivesEmailsOperator(
     task_id="IntensivesEmails",
     dag=dag,
 )
-# migrate_sipuni_calls_op = operators.MigrateSipuniCallsOperator(
-#     task_id="MigrateSipuniCalls",
-#     dag=dag,
-# )
+migrate_sipuni_calls_op = operators.MigrateSipuniCallsOperator(
+    task_id="MigrateSipuniCalls",
+    dag=dag,
+)
+match_sipuni_calls_op = operators.MatchSipuniCallsOperator(
+    task_id="MatchSipuniCalls",
+    dag=dag,
+)
 migrate_payment_analytic_op = operators.MigratePaymentAnalyticOperator(
     task_id="MigratePaymentAnalytic",
     dag=dag,
@@ -87,6 +93,14 @@ update_traffic_channels_op = operators.UpdateTrafficChannelsOperator(
     task_id="UpdateTrafficChannels",
     dag=dag,
 )
+migrate_amocrm_contacts_op = operators.MigrateAmocrmContactsOperator(
+    task_id="MigrateAmocrmContacts",
+    dag=dag,
+)
+update_lead_email_counts_op = operators.UpdateLeadEmailCountsOperator(
+    task_id="UpdateLeadEmailCounts",
+    dag=dag,
+)
 
 # update_amocrm_contacts_op = operators.UpdateAmocrmContacts(
 #     task_id="UpdateAmocrmContacts",
@@ -111,6 +125,8 @@ merge_amocrm_leads_op >> merge_related_leads_op
 
 merge_related_leads_op >> process_source_leads_op
 
+process_source_leads_op >> update_lead_email_counts_op
+
 process_source_leads_op >> intensives_emails_op
 
 intensives_emails_op >> update_paid_url_op
@@ -118,4 +134,8 @@ update_paid_url_op >> update_category_url_op
 
 roistat_analytic_op >> update_traffic_channels_op
 
-# intensives_emails_op >> migrate_sipuni_calls_op
+intensives_emails_op >> migrate_sipuni_calls_op
+
+migrate_sipuni_calls_op >> match_sipuni_calls_op
+migrate_amocrm_contacts_op >> match_sipuni_calls_op
+process_source_leads_op >> match_sipuni_calls_op
@@ -0,0 +1,121 @@
+"""
+Пропуск задач, входные данные которых не изменились с последнего
+успешного запуска.
+
+Задача объявляет входы в get_inputs: агрегаты таблиц, хэши содержимого
+таблиц и файлов plugins.data, ленты изменений _changes. Отпечаток входов
+сохраняется после успешного выполнения, при совпадении задача завершается
+без пересчета. Принудительный запуск: conf {"force": true} у запуска DAG.
+"""
+
+import abc
+import json
+import pickle
+import hashlib
+
+from typing import Dict, Any, Optional
+from logging import getLogger
+
+from scheduler.base import DjangoOperator
+
+
+logger = getLogger(__name__)
+
+FINGERPRINT_FILENAME = "task_fingerprint_{task_id}.json"
+
+
+def get_hash(value: Any) -> str:
+    return hashlib.md5(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def table(model, *fields: str) -> Dict[str, Any]:
+    """
+    Количество строк и максимумы полей fields (id, даты обновления)
+    """
+    from django.db.models import Count, Max
+
+    return model.objects.aggregate(
+        count=Count("pk"),
+        **dict((f"max_{field}", Max(field)) for field in fields),
+    )
+
+
+def table_content(model, *fields: str) -> str:
+    """
+    Хэш значений полей fields, для небольших таблиц, которые
+    перезаписываются целиком
+    """
+    digest = hashlib.md5()
+    for row in model.objects.order_by("pk").values_list(*fields).iterator():
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def artifact(filename: str) -> Optional[str]:
+    """
+    Хэш содержимого файла plugins.data, None если файла нет
+    """
+    from plugins.data import data_reader
+
+    try:
+        data = data_reader.dataframe(filename)
+    except FileNotFoundError:
+        return
+    return hashlib.md5(pickle.dumps(data)).hexdigest()
+
+
+def changes(name: str) -> float:
+    """
+    Время последнего изменения по ленте _changes
+    """
+    from apps.sources.management.commands._changes import get_changes
+
+    return max(get_changes(name).values(), default=0)
+
+
+class FingerprintOperator(DjangoOperator):
+    # BaseOperator Airflow создается через ABCMeta, поэтому наследник без
+    # get_inputs или run не создается
+    @abc.abstractmethod
+    def get_inputs(self) -> Dict[str, Any]:
+        pass
+
+    @abc.abstractmethod
+    def run(self, context=None):
+        pass
+
+    def get_fingerprint(self) -> Optional[str]:
+        from plugins.data import data_reader
+
+        try:
+            return data_reader.dict(
+                FINGERPRINT_FILENAME.format(task_id=self.task_id)
+            ).get("fingerprint")
+        except FileNotFoundError:
+            return
+
+    def is_forced(self, context=None) -> bool:
+        dag_run = (context or {}).get("dag_run")
+        conf = getattr(dag_run, "conf", None) or {}
+        return bool(conf.get("force"))
+
+    def execute(self, context=None):
+        from plugins.data import data_writer
+
+        fingerprint = get_hash(self.get_inputs())
+        if self.get_fingerprint() == fingerprint and not self.is_forced(
+            context
+        ):
+            logger.info(
+                "Inputs unchanged, skip: %(task)s" % {"task": self.task_id}
+            )
+            return
+
+        self.run(context)
+
+        data_writer.dict(
+            {"fingerprint": fingerprint},
+            FINGERPRINT_FILENAME.format(task_id=self.task_id),
+        )
@@ -0,0 +1,14 @@
+from scheduler.base import DjangoOperator
+
+
+# Пул Airflow на 1 слот: обновление по событиям и полный импорт сделок
+# (RemoteSources.MigrateAmocrmLeads) не выполняются одновременно.
+# Создается один раз: airflow pools set amocrm_leads 1 "Сделки AmoCRM"
+AMOCRM_LEADS_POOL = "amocrm_leads"
+
+
+class Operator(DjangoOperator):
+    def execute(self, context=None):
+        from django.core.management import call_command
+
+        call_command("migrate_amocrm_events")
@@ -1,9 +1,17 @@
+import os
 import pandas
 import datetime
 
 from django.utils import timezone
 
 from scheduler.base import DjangoOperator
+from scheduler.fingerprint import (
+    FingerprintOperator,
+    table,
+    table_content,
+    artifact,
+    changes,
+)
 
 
 class CollectLeadsOperator(DjangoOperator):
@@ -13,40 +21,99 @@ class CollectLeadsOperator(DjangoOperator):
         call_command("collect_leads")
 
 
-class IPLReportOperator(DjangoOperator):
-    def execute(self, context=None):
+class IPLReportOperator(FingerprintOperator):
+    def get_date_from(self) -> datetime.date:
+        return timezone.now().date() - datetime.timedelta(days=40)
+
+    def get_inputs(self):
+        from apps.sources.models import RoistatAnalytic, RoistatDimension
+
+        return {
+            "date_from": self.get_date_from(),
+            "roistat_analytic": table(RoistatAnalytic),
+            "roistat_analytic_changes": changes("roistat_analytic"),
+            "roistat_dimension": table_content(
+                RoistatDimension, "type", "name", "title"
+            ),
+        }
+
+    def run(self, context=None):
         from django.core.management import call_command
 
         call_command(
             "ipl_report",
-            date_from=timezone.now().date() - datetime.timedelta(days=40),
+            date_from=self.get_date_from(),
+            workers=min(os.cpu_count() or 1, 8),
+            changed=not self.is_forced(context),
         )
 
 
-class CollectPaymentChannelOperator(DjangoOperator):
-    def execute(self, context=None):
+class CollectPaymentChannelOperator(FingerprintOperator):
+    def get_inputs(self):
+        from apps.sources.models import PaymentAnalytic
+
+        return {
+            "payment_analytic": table_content(
+                PaymentAnalytic,
+                "date_payment",
+                "date_last_paid",
+                "profit",
+                "amocrm_id",
+                "roistat_url",
+                "params",
+            ),
+        }
+
+    def run(self, context=None):
         from django.core.management import call_command
 
         call_command("collect_payment_channel")
 
 
-class FunnelChannelReportOperator(DjangoOperator):
-    def execute(self, context=None):
+class FunnelChannelReportOperator(FingerprintOperator):
+    def get_inputs(self):
+        from apps.sources.models import RoistatDimension
+        from apps.traffic.models import FunnelChannelUrl
+
+        return {
+            "payment_channel": artifact("payment_channel.pkl"),
+            "ipl_report": artifact("ipl_report.pkl"),
+            "funnel_channel_url": table_content(
+                FunnelChannelUrl, "group", "url"
+            ),
+            "roistat_dimension": table_content(
+                RoistatDimension, "type", "name", "title"
+            ),
+        }
+
+    def run(self, context=None):
         from django.core.management import call_command
 
         call_command("funnel_channel_report")
 
 
-class RoistatChannelExpensesOperator(DjangoOperator):
-    def execute(self, context=None):
+class RoistatChannelExpensesOperator(FingerprintOperator):
+    def get_inputs(self):
+        from django.db.models import Sum
+        from apps.traffic.models import ExpensesDaily
+
+        return {
+            "expenses_daily": {
+                **table(ExpensesDaily, "date"),
+                **ExpensesDaily.objects.aggregate(sum_expenses=Sum("expenses")),
+            },
+            "roistat_analytic_changes": changes("roistat_analytic"),
+        }
+
+    def run(self, context=None):
         from plugins.data import data_writer
-        from apps.sources.models import RoistatAnalytic
+        from apps.traffic.models import ExpensesDaily
 
         data = (
             pandas.DataFrame(
                 data=list(
-                    RoistatAnalytic.objects.values_list(
-                        "date", "expenses", "dimension_marker_level_1__id"
+                    ExpensesDaily.objects.values_list(
+                        "date", "expenses", "channel"
                     )
                 ),
                 columns=["date", "expenses", "channel"],
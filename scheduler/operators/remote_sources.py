@@ -67,6 +67,20 @@ class MergeRelatedLeadsOperator(DjangoOperator):
         call_command("merge_related_leads")
 
 
+class MigrateAmocrmContactsOperator(DjangoOperator):
+    def execute(self, context=None):
+        from django.core.management import call_command
+
+        call_command("migrate_amocrm_contacts", incremental=True)
+
+
+class UpdateLeadEmailCountsOperator(DjangoOperator):
+    def execute(self, context=None):
+        from django.core.management import call_command
+
+        call_command("update_lead_email_counts")
+
+
 class ProcessSourceLeadsOperator(DjangoOperator):
     def execute(self, context=None):
         from django.core.management import call_command
@@ -110,6 +124,13 @@ class MigrateSipuniCallsOperator(DjangoOperator):
         )
 
 
+class MatchSipuniCallsOperator(DjangoOperator):
+    def execute(self, context=None):
+        from django.core.management import call_command
+
+        call_command("match_sipuni_calls")
+
+
 class MigratePaymentAnalyticOperator(DjangoOperator):
     def execute(self, context=None):
         from django.core.management import call_command